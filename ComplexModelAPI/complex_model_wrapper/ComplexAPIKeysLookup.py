@@ -1,6 +1,10 @@
+import base64
 import itertools
 import json
 
+import numpy as np
+import pandas as pd
+
 from oasislmf.utils import (
     coverages,
     peril,
@@ -13,13 +17,95 @@ from oasislmf.utils.status import (
 )
 from oasislmf.preparation.lookup import OasisBaseKeysLookup
 
+# Location fields passed to the API in model_data
+MODEL_DATA_FIELDS = ['latitude', 'longitude', 'occupancycode', 'constructioncode', 'yearbuilt']
+
+# Fixed-width binary record for the compact model_data format. Two bytes of
+# padding make the record a multiple of 3 bytes, so every record encodes to
+# exactly 40 base64 characters and a whole column can be encoded or decoded
+# in one call.
+MODEL_DATA_RECORD_DTYPE = np.dtype([
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('occupancycode', '<i4'),
+    ('constructioncode', '<i4'),
+    ('yearbuilt', '<i4'),
+    ('_pad', 'V2'),
+])
+MODEL_DATA_RECORD_CHARS = MODEL_DATA_RECORD_DTYPE.itemsize * 4 // 3
+
+# OED defaults for the integer fields of the binary record, which has no
+# missing value (latitude and longitude keep NaN)
+MODEL_DATA_INT_DEFAULTS = {'occupancycode': 1000, 'constructioncode': 5000, 'yearbuilt': 0}
+
+
+def _json_column(values):
+    """json.dumps of every value in a column, encoding each distinct value once."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    encoded = np.array([json.dumps(v) for v in uniques.tolist()], dtype=object)
+    return encoded[codes]
+
+
+def encode_model_data(loc_df, model_data_format='json'):
+    """
+    Build the model_data string for every location, column by column.
+
+    'json' gives the same text as json.dumps() of a dict of MODEL_DATA_FIELDS;
+    'binary' gives the base64 of a MODEL_DATA_RECORD_DTYPE record, about a
+    third of the size, which decode_model_data() reads back without parsing.
+    Missing integer fields are stored as their OED default
+    (MODEL_DATA_INT_DEFAULTS).
+    """
+
+    if model_data_format == 'json':
+        model_data = np.full(len(loc_df), '{', dtype=object)
+        for i, field in enumerate(MODEL_DATA_FIELDS):
+            separator = ', ' if i else ''
+            model_data = model_data + f'{separator}"{field}": ' + _json_column(loc_df[field])
+        return model_data + '}'
+
+    if model_data_format == 'binary':
+        records = np.zeros(len(loc_df), dtype=MODEL_DATA_RECORD_DTYPE)
+        for field in MODEL_DATA_FIELDS:
+            values = loc_df[field]
+            if field in MODEL_DATA_INT_DEFAULTS:
+                values = values.fillna(MODEL_DATA_INT_DEFAULTS[field])
+            records[field] = values.to_numpy()
+        encoded = np.frombuffer(base64.b64encode(records.tobytes()), dtype=f'S{MODEL_DATA_RECORD_CHARS}')
+        return encoded.astype(str).astype(object)
+
+    raise ValueError(f"Unknown model_data format '{model_data_format}', expected 'json' or 'binary'")
+
+
+def decode_model_data(model_data):
+    """
+    Read model_data strings in either format back into a DataFrame of
+    MODEL_DATA_FIELDS. The format is detected from the first value.
+
+    Nothing in this package calls it: model_data is only read by the loss
+    API, and this is the helper for that side (or for inspecting
+    complex_items).
+    """
+
+    model_data = pd.Series(model_data, dtype=object)
+    if len(model_data) == 0 or model_data.iloc[0].startswith('{'):
+        return pd.DataFrame([json.loads(s) for s in model_data], columns=MODEL_DATA_FIELDS)
+
+    records = np.frombuffer(base64.b64decode(''.join(model_data)), dtype=MODEL_DATA_RECORD_DTYPE)
+    return pd.DataFrame({field: records[field] for field in MODEL_DATA_FIELDS})
+
+
 class ComplexAPIKeysLookup(OasisBaseKeysLookup):
 
-    def __init__(self, 
+    # 'json' (default) or 'binary', see encode_model_data()
+    model_data_format = 'json'
+
+    def __init__(self,
             keys_data_directory=None,
             supplier=None,
             model_name=None,
             model_version=None,
+            model_data_format=None,
             **kwargs):
 
         self._peril_ids = [
@@ -31,38 +117,48 @@ class ComplexAPIKeysLookup(OasisBaseKeysLookup):
             coverages.COVERAGE_TYPES['contents']['id']
         ]
 
+        if model_data_format is not None:
+            self.model_data_format = model_data_format
+
 
     def process_location(self, loc, peril_id, coverage_type):
 
         status = OASIS_KEYS_SC
 
-        latitude = loc['latitude']
-        longitude = loc['longitude']
-        occupancycode = loc['occupancycode']
-        constructioncode = loc['constructioncode']
-        yearbuilt = loc['yearbuilt']
-
-        data = {
-                "latitude": latitude,
-                "longitude": longitude,
-                "occupancycode": occupancycode,
-                "constructioncode": constructioncode,
-                "yearbuilt": yearbuilt
-                }
+        model_data = encode_model_data(
+            pd.DataFrame([{field: loc[field] for field in MODEL_DATA_FIELDS}]),
+            self.model_data_format
+        )[0]
 
         return {
                 'loc_id': loc['loc_id'],
                 'peril_id': peril_id,
                 'coverage_type': coverage_type,
-                'model_data': json.dumps(data),
+                'model_data': model_data,
                 'status': status
                 }
 
     def process_locations(self, loc_df):
+        """
+        Keys for every location, peril and coverage type, as one DataFrame.
+
+        model_data is built once per location, column by column, and the
+        locations are then cross-joined with the (peril, coverage type)
+        pairs, giving the rows in the same order as process_location() over
+        product(locations, perils, coverage types).
+        """
 
         loc_df = loc_df.rename(columns=str.lower)
 
-        locs_seq = (loc for _, loc in loc_df.iterrows())
-        for loc, peril_id, coverage_type in \
-                itertools.product(locs_seq, self._peril_ids, self._coverage_types):
-            yield self.process_location(loc, peril_id, coverage_type)
+        locs = pd.DataFrame({
+            'loc_id': loc_df['loc_id'].to_numpy(),
+            'model_data': encode_model_data(loc_df, self.model_data_format),
+        })
+        perils_coverages = pd.DataFrame(
+            list(itertools.product(self._peril_ids, self._coverage_types)),
+            columns=['peril_id', 'coverage_type']
+        )
+        perils_coverages['status'] = OASIS_KEYS_SC
+
+        keys = locs.merge(perils_coverages, how='cross')
+        return keys[['loc_id', 'peril_id', 'coverage_type', 'model_data', 'status']]
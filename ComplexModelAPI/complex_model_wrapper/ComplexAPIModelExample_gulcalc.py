@@ -1,14 +1,14 @@
 import argparse
 import json
 import logging
-import math
 import numpy as np
 import os
 import pandas as pd
 import struct
 import sys
 
-from .api_hook import run_api
+from .api_hook import iter_api
+from .event_batches import batch_event_ids, read_event_ids
 
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
@@ -81,26 +81,16 @@ def get_event_ids(inputs_dir, event_batch, max_event_batch):
     :dtype: numpy.ndarray
     """
 
-    # Check events file exists and open it
+    # Check events file exists and read it
     events_file = 'events.bin'
     events_fp = os.path.join(inputs_dir, events_file);
     if not os.path.exists(events_fp):
         raise Exception('Events file does not exist.')
-    with os.popen(f'evetocsv < {events_fp}') as p:
-        df_events = pd.read_csv(p)
+    event_ids = read_event_ids(inputs_dir, events_file)
 
-    # Randomise event IDs and sort into batches
-    np.random.seed(1234)   # Use same random seed for all batches
-    df_events['event_id'] = np.random.choice(
-        df_events['event_id'], df_events.size, replace=False
-    )
-    chunksize = math.ceil(df_events.size / max_event_batch)
-    start_position = chunksize * (event_batch - 1)
-    end_position = chunksize * event_batch
-    if end_position > df_events.size:
-        end_position = df_events.size
-
-    return df_events['event_id'].to_numpy()[start_position:end_position]
+    # Randomise event IDs and sort into batches (same split as the other
+    # complex model wrappers)
+    return batch_event_ids(event_ids, event_batch, max_event_batch)
 
 
 def get_items(input_dir):
@@ -121,15 +111,68 @@ def get_items(input_dir):
     return df_items
 
 
-def gul_calc(event_batch,event_ids, number_of_samples, df_items):
+def gul_calc(event_batch,event_ids, number_of_samples, df_items, model_settings, inputs_dir):
     """
     This is where you would run your api
-    Links to dummy function for now
+    Links to dummy function unless model_settings sets api_url, and returns
+    the losses one event at a time
+
+    :param model_settings: model_settings from the analysis settings;
+        api_url (API base URL) and api_max_in_flight (concurrent requests,
+        default 16) configure the API client
+    :dtype model_settings: dict
+
+    :param inputs_dir: inputs directory, where the API items handle is kept
+    :dtype inputs_dir: str
+    """
+
+    return iter_api(
+        event_batch, event_ids, number_of_samples, df_items,
+        api_url=model_settings.get('api_url'),
+        max_in_flight=model_settings.get('api_max_in_flight', 16),
+        cache_dir=inputs_dir,
+    )
+
+
+def encode_losses(df_gul):
+    """
+    Encode GULs as loss stream records in one contiguous buffer.
+
+    There is one record per (event_id, item_id) pair, in order of first
+    appearance in df_gul, holding that pair's (sidx, loss) rows in their
+    original order:
+
+      event_id (i4)  item_id (i4)
+      sidx (i4)      loss (f4)      <- one pair per row
+      ...
+      0 (i4)         0.0 (f4)       <- terminator
+
+    :param df_gul: Ground Up Losses (GULs) with event_id, item_id, sidx and
+        loss columns
+    :dtype df_gul: pandas.DataFrame
+
+    :return: encoded records as 4-byte words in native byte order
+    :dtype: numpy.ndarray
     """
 
-    df_gul_calc = run_api(event_batch,event_ids, number_of_samples, df_items)
+    group = df_gul.groupby(['event_id', 'item_id'], sort=False).ngroup().to_numpy()
+    order = np.argsort(group, kind='stable')
+    counts = np.bincount(group)
 
-    return df_gul_calc
+    # Offsets (in 4-byte words) of each record, and of each row's pair in it
+    record_words = 4 + 2 * counts
+    record_start = np.cumsum(record_words) - record_words
+    first_row = np.cumsum(counts) - counts
+    rank = np.arange(len(order)) - np.repeat(first_row, counts)
+    pair_start = np.repeat(record_start, counts) + 2 + 2 * rank
+
+    buf = np.zeros(record_words.sum(), dtype=np.int32)
+    buf[record_start] = df_gul['event_id'].to_numpy()[order[first_row]]
+    buf[record_start + 1] = df_gul['item_id'].to_numpy()[order[first_row]]
+    buf[pair_start] = df_gul['sidx'].to_numpy()[order]
+    buf.view(np.float32)[pair_start + 1] = df_gul['loss'].to_numpy()[order]
+
+    return buf
 
 
 def write_loss_stream(number_of_samples, df_gul):
@@ -137,14 +180,14 @@ def write_loss_stream(number_of_samples, df_gul):
     Write loss stream to binary file in format expected by ktools exectuable
     summarycalc.
 
-    :param loss_output_stream: loss output stream
-    :dtype loss_output_stream: stdpout or file object
-
     :param number_of_samples: number of samples
     :dtype number_of_samples: int
 
-    :param df_gul: Ground Up Losses (GULs) for all samples
-    :dtype df_gul: pandas.DataFrame
+    :param df_gul: Ground Up Losses (GULs) for all samples, either as one
+        DataFrame or as an iterable of DataFrames (e.g. one per event from
+        api_hook.iter_api). Each DataFrame is encoded and written as one
+        buffer.
+    :dtype df_gul: pandas.DataFrame or iterable of pandas.DataFrame
     """
 
     # Write loss output stream header
@@ -152,14 +195,11 @@ def write_loss_stream(number_of_samples, df_gul):
     output_stdout.write(struct.pack('i', loss_stream_id))
     output_stdout.write(struct.pack('i', number_of_samples))
 
-    for event_id, item_id in df_gul[['event_id', 'item_id']].drop_duplicates().to_numpy():
-        output_stdout.write(struct.pack('i', event_id))
-        output_stdout.write(struct.pack('i', item_id))
-        for row in df_gul[(df_gul['event_id'] == event_id) & (df_gul['item_id'] == item_id)].itertuples(index=False):
-            output_stdout.write(struct.pack('i', row[2]))   # sidx
-            output_stdout.write(struct.pack('f', row[3]))   # loss
-        output_stdout.write(struct.pack('i', 0))
-        output_stdout.write(struct.pack('f', 0.0))
+    if isinstance(df_gul, pd.DataFrame):
+        df_gul = [df_gul]
+    for df in df_gul:
+        if len(df):
+            output_stdout.write(memoryview(encode_losses(df)).cast('B'))
 
 
 def main():
@@ -181,9 +221,12 @@ def main():
     # Read settings from analysis settings JSON
     analysis_settings = json.load(open(args.analysis_settings_file))
     number_of_samples = analysis_settings['number_of_samples']
+    model_settings = analysis_settings.get('model_settings') or {}
 
     # ktools gulcalc equivalent
-    df_gul_calc = gul_calc(event_batch, event_ids, number_of_samples, df_items)
+    df_gul_calc = gul_calc(
+        event_batch, event_ids, number_of_samples, df_items, model_settings, inputs_dir
+    )
 
 
     # Write loss stream to stdout
@@ -0,0 +1,196 @@
+"""
+HTTP client for a complex model loss API.
+
+The gulcalc wrapper sends the analysis items to the API once, then asks for
+the losses of each event in its batch:
+
+  HEAD /items/<digest>    200 if the API already holds these items
+  PUT  /items/<digest>    upload the items (JSON, one list per column)
+  POST /losses            {"items": <digest>, "event_id": e, "number_of_samples": n}
+                          -> {"item_id": [...], "sidx": [...], "loss": [...]}
+
+Items are addressed by the sha256 of their JSON payload. Each event batch
+checks the API with HEAD under a file lock on a handle file next to the
+analysis inputs, so the event batches of one analysis (separate gulcalc
+processes, usually running in parallel) upload the items once between them
+rather than once each. If the API forgets the items during the analysis
+(e.g. it was restarted), a loss request answered with 404 re-uploads them
+and is retried once.
+
+Loss requests are sent concurrently from one asyncio event loop, over a
+single connection pool, with at most max_in_flight requests outstanding.
+Results are yielded in event order as soon as each one arrives, so they can
+be written to the loss stream while later events are still being computed.
+
+aiohttp is only needed when an API URL is configured
+(pip install ComplexAPIModelExample[api]).
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+ITEMS_HANDLE_FILENAME = 'api_items_handle.json'
+
+
+class LossApiClient:
+    """
+    Client for one loss API, see the module docstring for the protocol.
+
+    :param api_url: base URL of the API, e.g. http://localhost:8080
+    :dtype api_url: str
+
+    :param max_in_flight: maximum number of concurrent loss requests
+    :dtype max_in_flight: int
+
+    :param timeout: total timeout per request, in seconds
+    :dtype timeout: float
+    """
+
+    def __init__(self, api_url, max_in_flight=16, timeout=300):
+        self.api_url = api_url.rstrip('/')
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self._payloads = {}
+        self._reupload = None
+
+    def _session(self):
+        import aiohttp
+
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            raise_for_status=True,
+        )
+
+    async def _open_session(self):
+        # aiohttp sessions must be created inside the event loop that uses them
+        return self._session()
+
+    async def _upload_items(self, payload, digest):
+        url = f'{self.api_url}/items/{digest}'
+        async with self._session() as session:
+            async with session.head(url, raise_for_status=False) as response:
+                if response.status == 200:
+                    return
+            log.info(f'Uploading {len(payload)} bytes of item data to {url}')
+            async with session.put(url, data=payload, headers={'Content-Type': 'application/json'}):
+                pass
+
+    def send_items(self, df_items, cache_dir):
+        """
+        Make sure the API holds the items, uploading them if needed.
+
+        :param df_items: complex items
+        :dtype df_items: pandas.DataFrame
+
+        :param cache_dir: directory for the handle file, shared by all event
+            batches of the analysis
+        :dtype cache_dir: str
+
+        :return: handle of the items on the API
+        :dtype: str
+        """
+
+        payload = json.dumps(df_items.to_dict(orient='list')).encode()
+        digest = hashlib.sha256(payload).hexdigest()
+        self._payloads[digest] = payload
+        handle_fp = os.path.join(cache_dir, ITEMS_HANDLE_FILENAME)
+
+        with open(handle_fp, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                handles = json.load(f)
+            except ValueError:
+                handles = {}
+            # the handle file only records what was sent; the API may have
+            # lost the items since, so always ask it
+            asyncio.run(self._upload_items(payload, digest))
+            if handles.get(self.api_url) != digest:
+                handles[self.api_url] = digest
+                f.seek(0)
+                f.truncate()
+                json.dump(handles, f)
+
+        return digest
+
+    async def _reupload_items(self, handle):
+        # concurrent requests that all got 404 share one upload
+        if self._reupload is None:
+            log.warning(f'{self.api_url} no longer holds items {handle}, uploading them again')
+            self._reupload = asyncio.ensure_future(self._upload_items(self._payloads[handle], handle))
+        await asyncio.shield(self._reupload)
+
+    async def _fetch_losses(self, session, handle, event_id, number_of_samples):
+        request = {'items': handle, 'event_id': int(event_id), 'number_of_samples': number_of_samples}
+        async with session.post(f'{self.api_url}/losses', json=request, raise_for_status=False) as response:
+            if response.status == 404 and handle in self._payloads:
+                retry = True
+            else:
+                response.raise_for_status()
+                retry = False
+                losses = await response.json()
+        if retry:
+            await self._reupload_items(handle)
+            async with session.post(f'{self.api_url}/losses', json=request) as response:
+                losses = await response.json()
+
+        item_id = np.asarray(losses['item_id'], dtype='int64')
+        return pd.DataFrame({
+            'event_id': np.full(len(item_id), event_id, dtype='int64'),
+            'item_id': item_id,
+            'sidx': np.asarray(losses['sidx'], dtype='int64'),
+            'loss': np.asarray(losses['loss'], dtype='float'),
+        })
+
+    def iter_losses(self, handle, event_ids, number_of_samples):
+        """
+        Request the losses of each event, yielding one DataFrame per event in
+        the order of event_ids.
+
+        Up to max_in_flight requests run concurrently; the event loop only
+        runs while the caller waits for the next event, so a slow consumer
+        holds back new requests rather than buffering results.
+        """
+
+        loop = asyncio.new_event_loop()
+        self._reupload = None
+        session = loop.run_until_complete(self._open_session())
+        events = iter(event_ids)
+        pending = deque()
+        start = time.monotonic()
+        n_events = 0
+
+        def submit():
+            event_id = next(events, None)
+            if event_id is not None:
+                pending.append(loop.create_task(
+                    self._fetch_losses(session, handle, event_id, number_of_samples)
+                ))
+
+        try:
+            for _ in range(self.max_in_flight):
+                submit()
+            while pending:
+                df = loop.run_until_complete(pending.popleft())
+                submit()
+                n_events += 1
+                yield df
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(session.close())
+            loop.close()
+            elapsed = time.monotonic() - start
+            log.info(f'Received losses for {n_events} events in {elapsed:.2f}s')
@@ -1,40 +1,83 @@
+import numpy as np
 import pandas as pd
 
 static_loss = 100000
 
-def run_api(event_batch, event_ids, number_of_samples, df_items):
+cols = ['event_id', 'item_id', 'sidx', 'loss']
+
 
+def sample_indices(number_of_samples):
     """
-    dummy api run - returns static losses for inputs
+    sidx values returned for every event and item, in output order:
+    the special indices -5..-1 followed by samples 1..number_of_samples.
+    """
+    return np.concatenate([np.arange(-5, 0), np.arange(1, number_of_samples + 1)])
+
+
+def build_loss_table(event_ids, item_ids, number_of_samples):
+    """
+    dummy api losses for every (event, item, sidx) combination - static losses
+
+    The table is built with one broadcast over (event, item, sidx) and is
+    already sorted by event_id, item_id then sidx, so no concat or sort is
+    needed.
     """
+    event_ids = np.sort(np.asarray(event_ids))
+    item_ids = np.sort(np.asarray(item_ids))
+    sidx = sample_indices(number_of_samples)
+    shape = (len(event_ids), len(item_ids), len(sidx))
+
+    return pd.DataFrame({
+        'event_id': np.broadcast_to(event_ids[:, None, None], shape).ravel(),
+        'item_id': np.broadcast_to(item_ids[None, :, None], shape).ravel(),
+        'sidx': np.broadcast_to(sidx[None, None, :], shape).ravel(),
+        'loss': np.full(np.prod(shape), static_loss, dtype='float'),
+    }, columns=cols)
 
+
+def send_items(event_batch, df_items):
     if event_batch==1:
         # send item data to api to generate event data
         # assume we don't want to send the same thing many times.
         # skip for now
         pass
-    
 
-    df_gul_calc = pd.DataFrame(
-        {
-        'event_id': pd.Series(dtype='int'),
-        'item_id': pd.Series(dtype='int'),
-        'sidx': pd.Series(dtype='int'),
-        'loss': pd.Series(dtype='float'),
-        }
-        )
-    
-    cols = ['event_id','item_id','sidx','loss']
 
-    list_sidx = [*range(-5,0,1)] + [*range(1,number_of_samples+1,1)]
+def run_api(event_batch, event_ids, number_of_samples, df_items):
+
+    """
+    dummy api run - returns static losses for inputs
+    """
+
+    send_items(event_batch, df_items)
+
+    return build_loss_table(event_ids, df_items['item_id'].to_numpy(), number_of_samples)
 
-    for event_id in event_ids:
-        for sidx in list_sidx:
-            df_item_tmp = df_items[['item_id']].copy()
-            df_item_tmp['event_id'] = event_id
-            df_item_tmp['sidx'] = sidx
-            df_item_tmp['loss'] = static_loss
 
-            df_gul_calc = pd.concat([df_gul_calc,df_item_tmp[cols]])
+def iter_api(event_batch, event_ids, number_of_samples, df_items,
+             api_url=None, max_in_flight=16, cache_dir='.'):
 
-    return df_gul_calc.sort_values(by=cols)
\ No newline at end of file
+    """
+    api run, one event at a time - yields the losses of each event in the
+    same order as run_api(), so the whole table is never held in memory
+
+    Without an api_url this is the dummy api (static losses). With one, the
+    items are sent to the API once per analysis and the events are requested
+    concurrently by api_client.LossApiClient.
+    """
+
+    event_ids = np.sort(np.asarray(event_ids))
+
+    if api_url:
+        from .api_client import LossApiClient
+
+        client = LossApiClient(api_url, max_in_flight=max_in_flight)
+        handle = client.send_items(df_items, cache_dir)
+        yield from client.iter_losses(handle, event_ids, number_of_samples)
+        return
+
+    send_items(event_batch, df_items)
+
+    item_ids = df_items['item_id'].to_numpy()
+    for event_id in event_ids:
+        yield build_loss_table([event_id], item_ids, number_of_samples)
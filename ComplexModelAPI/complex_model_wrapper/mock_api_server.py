@@ -0,0 +1,87 @@
+"""
+Local stand-in for a complex model loss API, for development and offline
+benchmarking of the gulcalc client (see api_client.py for the protocol).
+
+It returns the same static losses as the dummy api_hook.run_api(), after
+sleeping for a configurable latency per loss request, so a gulcalc run
+against it produces the same loss stream as the dummy hook.
+
+DELETE /items/<digest> makes it forget a set of items, as a restarted API
+would, to exercise the client's re-upload.
+
+    ComplexAPIModelExample_mock_server --port 8080 --latency 0.1
+
+Requires aiohttp (pip install ComplexAPIModelExample[api]).
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+from aiohttp import web
+
+from .api_hook import build_loss_table
+
+log = logging.getLogger(__name__)
+
+
+def create_app(latency=0.0):
+    """
+    Build the mock API application.
+
+    :param latency: seconds to wait before answering each loss request
+    :dtype latency: float
+    """
+
+    items = {}
+
+    async def head_items(request):
+        if request.match_info['digest'] not in items:
+            raise web.HTTPNotFound()
+        return web.Response()
+
+    async def put_items(request):
+        digest = request.match_info['digest']
+        items[digest] = (await request.json())['item_id']
+        log.info(f'Stored {len(items[digest])} items as {digest}')
+        return web.json_response({'items': digest})
+
+    async def delete_items(request):
+        if items.pop(request.match_info['digest'], None) is None:
+            raise web.HTTPNotFound()
+        return web.Response()
+
+    async def post_losses(request):
+        body = await request.json()
+        if body['items'] not in items:
+            raise web.HTTPNotFound(text='Unknown items handle')
+        await asyncio.sleep(latency)
+        df = build_loss_table([body['event_id']], items[body['items']], body['number_of_samples'])
+        return web.json_response({
+            'item_id': df['item_id'].tolist(),
+            'sidx': df['sidx'].tolist(),
+            'loss': df['loss'].tolist(),
+        })
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_head('/items/{digest}', head_items)
+    app.router.add_put('/items/{digest}', put_items)
+    app.router.add_delete('/items/{digest}', delete_items)
+    app.router.add_post('/losses', post_losses)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock complex model loss API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds to wait before answering each loss request (default 0.05)')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    web.run_app(create_app(args.latency), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
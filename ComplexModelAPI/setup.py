@@ -6,9 +6,13 @@ setup(
     name='ComplexAPIModelExample',
     version='0.0.0.1',
     packages=find_packages(),
+    extras_require={
+        'api': ['aiohttp'],
+    },
     entry_points={
         'console_scripts': [
-            'ComplexAPIModelExample_gulcalc=complex_model_wrapper.ComplexAPIModelExample_gulcalc:main'
+            'ComplexAPIModelExample_gulcalc=complex_model_wrapper.ComplexAPIModelExample_gulcalc:main',
+            'ComplexAPIModelExample_mock_server=complex_model_wrapper.mock_api_server:main'
         ]
     }
 )
@@ -10,6 +10,7 @@ import io
 import os
 
 # Python non-standard library imports
+import numpy as np
 import pandas as pd
 
 # Oasis utils and other Oasis imports
@@ -49,20 +50,28 @@ class DeterministicKeysLookup(OasisBaseKeysLookup):
         with io.open(os.path.join(self.keys_data_directory,'areaperils.json'),'r',encoding='utf-8') as ap:
             self.areaperils = json.load(ap)
 
-    def get_perils(self,locperilscovered):
-        source_peril_list = locperilscovered.replace(' ','').split(';')
-        target_peril_list = []
+        # resolved (peril, areaperil) pairs per covered perils string, with
+        # spaces removed; every single peril or peril group code is resolved
+        # here, combinations such as 'WTC;WSS' on first use
+        self._covered_perils = {}
+        for code in self.perils:
+            self._resolve_perils(code)
 
-        if len(source_peril_list) > 0:
-            for sp in source_peril_list:
-                target_perils = self.perils[sp]
-                for tp in target_perils:
-                    target_peril_list.append(tp)
-        
-        #remove duplicates
-        return_perils = list(set(target_peril_list))
+    def _resolve_perils(self, locperilscovered):
+        """
+        (peril, areaperil) pairs covered by a LocPerilsCovered string,
+        duplicates removed, in order of first appearance. Memoized.
+        """
+        key = locperilscovered.replace(' ','')
+        resolved = self._covered_perils.get(key)
+        if resolved is None:
+            perils = dict.fromkeys(tp for sp in key.split(';') for tp in self.perils[sp])
+            resolved = [(tp, self.get_areaperil(tp)) for tp in perils]
+            self._covered_perils[key] = resolved
+        return resolved
 
-        return return_perils
+    def get_perils(self,locperilscovered):
+        return [tp for tp, _ in self._resolve_perils(locperilscovered)]
 
     def get_areaperil(self,peril):
         ap_id = self.areaperils[peril]
@@ -72,6 +81,10 @@ class DeterministicKeysLookup(OasisBaseKeysLookup):
     def process_locations(self, loc_df):
         """
         Process location rows - passed in as a pandas dataframe.
+
+        Returns one dataframe of keys: for each location, each of its
+        perils, coverages 1-4, with the vulnerability given by the
+        location's damage ratio for that coverage.
         """
 
         loc_df = loc_df.rename(columns=str.lower)
@@ -84,35 +97,48 @@ class DeterministicKeysLookup(OasisBaseKeysLookup):
             }
 
         #set dr = 100 where not provided
-        loc_df_cols = loc_df.columns
-        for col_id in required_columns:
-            if required_columns[col_id] not in loc_df_cols:
-                loc_df[required_columns[col_id]] = 1.0
-
-
-        for index, row in loc_df.iterrows():
-            loc_id = row['loc_id']
-            locperilscovered = row['locperilscovered']
-            lst_perils = self.get_perils(locperilscovered)
-            # replaced with just WTC for simplicity
-            # lst_perils = ['WTC']
-            status = OASIS_KEYS_STATUS['success']['id']
-
-
-            for peril in lst_perils:
-                ap_id = self.get_areaperil(peril)
-                for cov in range(1,5):
-                    dr_col = required_columns[cov]
-                    dr = float(row[dr_col])*100
-                    v_id = int(dr)
-
-                    yield {
-                        "loc_id": int(loc_id),
-                        "peril_id": peril,
-                        "coverage_type": int(cov),
-                        "area_peril_id": ap_id,
-                        "vulnerability_id": v_id,
-                        "message": '',
-                        "status": status
-                    }
-
+        # (values go through object so strings and categoricals convert
+        # value by value, as float() does)
+        dr = pd.DataFrame({
+            cov: (loc_df[col].to_numpy(dtype=object) if col in loc_df.columns else 1.0)
+            for cov, col in required_columns.items()
+        }, index=pd.RangeIndex(len(loc_df)))
+
+        # resolve each distinct covered perils string once, then join the
+        # resolved (peril, areaperil) table to the locations by category code
+        covered = pd.Categorical(loc_df['locperilscovered'])
+        codes = covered.codes.astype(np.int64)
+        categories = list(covered.categories) + ['']
+        codes[codes < 0] = len(categories) - 1     # missing resolves as ''
+
+        resolved = [[] for _ in categories]
+        for code in np.unique(codes):
+            resolved[code] = self._resolve_perils(str(categories[code]))
+        counts = np.array([len(r) for r in resolved], dtype=np.int64)
+        offsets = np.cumsum(counts) - counts
+        table = [pair for r in resolved for pair in r]
+        table_perils = np.array([tp for tp, _ in table], dtype=object)
+        table_areaperils = np.array([ap for _, ap in table], dtype=np.int64)
+
+        # one row per (location, peril), then per coverage 1-4, already in
+        # output order
+        loc_counts = counts[codes]
+        loc_pos = np.repeat(np.arange(len(codes)), loc_counts)
+        rank = np.arange(len(loc_pos)) - np.repeat(np.cumsum(loc_counts) - loc_counts, loc_counts)
+        table_pos = np.repeat(offsets[codes], loc_counts) + rank
+
+        n_covs = len(required_columns)
+        loc_pos = np.repeat(loc_pos, n_covs)
+        table_pos = np.repeat(table_pos, n_covs)
+        cov = np.tile(np.arange(1, n_covs + 1), len(table_pos) // n_covs)
+        vulnerability_ids = dr.astype(float).mul(100).astype(int).to_numpy()[loc_pos, cov - 1]
+
+        return pd.DataFrame({
+            "loc_id": loc_df['loc_id'].to_numpy()[loc_pos].astype(int),
+            "peril_id": table_perils[table_pos],
+            "coverage_type": cov,
+            "area_peril_id": table_areaperils[table_pos],
+            "vulnerability_id": vulnerability_ids,
+            "message": '',
+            "status": OASIS_KEYS_STATUS['success']['id']
+        })
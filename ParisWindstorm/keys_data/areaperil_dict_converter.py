@@ -1,19 +1,10 @@
-
-from shapely.geometry import Point
-import geopandas as gpd
-import pandas as pd
 import os
+import sys
 
-df = pd.read_csv(os.path.join(os.path.dirname(__file__), "areaperil_dict.csv"))
-df.rename(columns={column:column.lower() for column in df.columns}, inplace=True)
-
-# create the GeoDataFrame and its geometry
-gdf_peril_area = gpd.GeoDataFrame(df)
+keys_data_dir = os.path.dirname(os.path.abspath(__file__))
 
-gdf_peril_area["area_peril_geometry"] = gdf_peril_area.apply(lambda row: Point(row["longitude"], row["latitude"]),
-                                        axis=1,
-                                        result_type='reduce')
-gdf_peril_area = gdf_peril_area.set_geometry('area_peril_geometry')
+# shared converter, in the scripts directory at the root of the repository
+sys.path.insert(0, os.path.join(keys_data_dir, "..", "..", "scripts"))
+from areaperil_dict_builder import convert  # noqa: E402
 
-# store to parquet format
-gdf_peril_area.to_parquet(os.path.join(os.path.dirname(__file__), "areaperil_dict.parquet"))
\ No newline at end of file
+convert(keys_data_dir, geometry_column="area_peril_geometry")
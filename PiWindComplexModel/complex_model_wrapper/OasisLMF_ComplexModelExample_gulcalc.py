@@ -3,7 +3,8 @@ Complex model GUL wrapper — PiWind demo.
 
 Demonstrates how a supplier model integrates with the oasislmf ktools pipeline:
   - Reads complex_items.bin (supplier-specific per-item model data)
-  - Reads footprint.bin/.idx to determine per-event hazard intensity per location
+  - Reads footprint.bin/.idx (or the zlib-compressed .z pair) to determine
+    per-event hazard intensity per location
   - Generates GUL samples and writes the binary stream expected by ktools downstream
 
 The loss model is intentionally simple (intensity-weighted random fraction of TIV)
@@ -11,13 +12,22 @@ so the integration wiring is easy to follow. A production model would replace
 compute_guls() with a full vulnerability CDF lookup.
 """
 import argparse
+import fcntl
+import io
 import json
 import logging
 import msgpack
+import multiprocessing
 import numpy as np
 import os
+import shutil
 import struct
 import sys
+import tempfile
+import zlib
+from collections import OrderedDict, deque
+
+from .event_batches import event_batch_slice, read_event_ids, shuffle_events
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -30,10 +40,20 @@ _ITEM_HDR_DTYPE = np.dtype([
 ])
 # coverages.bin is a flat float32 array; tiv for coverage_id k is coverages[k-1]
 _COVERAGES_DTYPE = np.float32
-_EVENTS_DTYPE = np.dtype([('event_id', '<i4')])
 _FP_IDX_DTYPE = np.dtype([('event_id', '<i4'), ('offset', '<i8'), ('size', '<i8')])
+# footprint.idx.z carries the uncompressed size too when the header flags it
+_FP_IDX_Z_DTYPE = np.dtype([('event_id', '<i4'), ('offset', '<i8'), ('size', '<i8'), ('d_size', '<i8')])
 _FP_RECORD_DTYPE = np.dtype([('areaperil_id', '<u4'), ('intensity_bin_id', '<i4'), ('probability', '<f4')])
 _FP_HEADER_SIZE = 8   # footprint.bin: num_intensity_bins (i4) + has_intensity_uncertainty (i4)
+_FP_UNCOMPRESSED_SIZE_FLAG = 2   # has_intensity_uncertainty bit set when footprint.idx.z has d_size
+# precomputed per-event intensity table (see write_intensity_table)
+_INTENSITY_HEADER_DTYPE = np.dtype([
+    ('version', '<i4'), ('num_events', '<i4'),
+    ('bin_size', '<i8'), ('bin_mtime_ns', '<i8'), ('idx_size', '<i8'), ('idx_mtime_ns', '<i8'),
+])
+_INTENSITY_IDX_DTYPE = np.dtype([('event_id', '<i4'), ('offset', '<i8'), ('count', '<i8')])
+_INTENSITY_RECORD_DTYPE = np.dtype([('areaperil_id', '<u4'), ('intensity', '<f4')])
+_INTENSITY_VERSION = 3
 
 GUL_STREAM_ID = (2 << 24) | 1
 
@@ -52,6 +72,23 @@ def parse_arguments():
     parser.add_argument('-i', '--loss-output-stream', required=False, default='-',
                         nargs='?', const='-',
                         help='Output file path, or - for stdout (default); bare -i also means stdout')
+    parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                        help='Read the footprint into process memory instead of memory-mapping it')
+    parser.add_argument('--no-items-cache', dest='use_items_cache', action='store_false',
+                        help='Do not read or write the parsed complex items .npz sidecar')
+    parser.add_argument('--no-shared-cache', dest='use_shared_cache', action='store_false',
+                        help='Load items, coverages and events in this process instead of attaching '
+                             'to the shared per-analysis cache')
+    parser.add_argument('--write-buffer-size', type=int, default=1 << 20,
+                        help='Bytes of GUL records to collect before each write to the output stream '
+                             '(default 1 MiB; 0 writes every event separately)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to split the event batch over (default 1)')
+    parser.add_argument('--footprint-cache-size', type=int, default=64,
+                        help='Number of decompressed events kept when reading footprint.bin.z (default 64)')
+    parser.add_argument('--memory-budget', type=int, default=256 << 20,
+                        help='Bytes of GUL rows and random numbers to compute at once; larger events '
+                             'are computed in chunks of items (default 256 MiB)')
 
     args = parser.parse_args()
 
@@ -78,7 +115,7 @@ def parse_arguments():
 # Data loading
 # ---------------------------------------------------------------------------
 
-def read_complex_items(inputs_dir, filename):
+def read_complex_items(inputs_dir, filename, use_cache=True):
     """
     Parse complex_items.bin.
 
@@ -88,41 +125,366 @@ def read_complex_items(inputs_dir, filename):
     model_data is a msgpack-encoded string containing a JSON dict with at least
     'area_peril_id' and 'vulnerability_id' keys.  Only area_peril_id is used here.
 
+    Record boundaries are found in a single pass over the headers, then all
+    headers are gathered into one structured array and the model_data of every
+    item is decoded in bulk (see _decode_area_peril_ids).
+
+    With use_cache the result is saved next to the file as <filename>.npz,
+    keyed on the file's size and mtime, so later batches of the same analysis
+    load the arrays directly instead of parsing the file again.
+
     Returns four parallel int32/uint32 arrays: item_id, coverage_id, group_id, area_peril_id.
     """
-    raw = np.frombuffer(open(os.path.join(inputs_dir, filename), 'rb').read(), dtype=np.uint8)
+    items_fp = os.path.join(inputs_dir, filename)
+    cache_fp = items_fp + '.npz'
+    st = os.stat(items_fp)
+    cache_key = np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+    if use_cache:
+        cached = _load_items_cache(cache_fp, cache_key)
+        if cached is not None:
+            return cached
+
+    raw = np.fromfile(items_fp, dtype=np.uint8)
+    hdr_size = _ITEM_HDR_DTYPE.itemsize
+    offsets = _item_record_offsets(raw)
+
+    # gather the fixed-size headers column by column to avoid an
+    # (n_items x hdr_size) int64 index array
+    hdr_bytes = np.empty((len(offsets), hdr_size), dtype=np.uint8)
+    for j in range(hdr_size):
+        hdr_bytes[:, j] = raw[offsets + j]
+    hdrs = hdr_bytes.view(_ITEM_HDR_DTYPE)[:, 0]
+
+    md_starts = offsets + hdr_size
+    md_lens = np.minimum(hdrs['model_data_len'].astype(np.int64), len(raw) - md_starts)
+
+    items = (
+        hdrs['item_id'].astype(np.int32),
+        hdrs['coverage_id'].astype(np.uint32),
+        hdrs['group_id'].astype(np.uint32),
+        _decode_area_peril_ids(raw, md_starts, md_lens),
+    )
+
+    if use_cache:
+        _save_items_cache(cache_fp, cache_key, items)
+    return items
+
+
+_ITEMS_CACHE_FIELDS = ('item_id', 'coverage_id', 'group_id', 'area_peril_id')
+
+
+def _load_items_cache(cache_fp, cache_key):
+    """Item arrays from a .npz sidecar, or None if missing or stale."""
+    if not os.path.exists(cache_fp):
+        return None
+    try:
+        with np.load(cache_fp) as cached:
+            if not np.array_equal(cached['source_key'], cache_key):
+                return None
+            return tuple(cached[name] for name in _ITEMS_CACHE_FIELDS)
+    except (OSError, ValueError, KeyError):
+        log.warning(f'Ignoring unreadable complex items cache {cache_fp}')
+        return None
+
+
+def _save_items_cache(cache_fp, cache_key, items):
+    """
+    Write the item arrays to a .npz sidecar.
+
+    The file is written under a temporary name and renamed into place, so
+    concurrent batches never see a partial cache.
+    """
+    tmp_fp = f'{cache_fp}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_fp, 'wb') as f:
+            np.savez(f, source_key=cache_key, **dict(zip(_ITEMS_CACHE_FIELDS, items)))
+        os.replace(tmp_fp, cache_fp)
+    except OSError as e:
+        log.warning(f'Could not write complex items cache {cache_fp}: {e}')
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+
+
+# consecutive equal-length records seen before switching to strided reads
+_STRIDE_PROBE_RUN = 8
+_STRIDE_WINDOW = 1024
+
+
+def _item_record_offsets(raw):
+    """
+    Byte offset of every record in complex_items.bin.
+
+    Records are variable length, so boundaries have to be walked, but only
+    the model_data_len field of each header is read. Once a run of records
+    with the same model_data length is seen (e.g. fixed-width model_data),
+    the following headers are read as one strided array, in windows that
+    double in size while the run continues.
+    """
     hdr_size = _ITEM_HDR_DTYPE.itemsize
+    len_pos = _ITEM_HDR_DTYPE.fields['model_data_len'][1]
+    size = len(raw)
+    buf = raw.data
+
+    chunks, scalar = [], []
+    cursor, run, last_len = 0, 0, -1
+    while cursor + hdr_size <= size:
+        md_len = struct.unpack_from('<I', buf, cursor + len_pos)[0]
+        rec_size = hdr_size + md_len
+        run = run + 1 if md_len == last_len else 1
+        last_len = md_len
+        if run < _STRIDE_PROBE_RUN:
+            scalar.append(cursor)
+            cursor += rec_size
+            continue
+
+        n_max = (size - cursor - hdr_size) // rec_size + 1
+        n, window = 0, _STRIDE_WINDOW
+        while n < n_max:
+            m = min(window, n_max - n)
+            lens = np.ndarray((m,), dtype='<u4', buffer=raw,
+                              offset=cursor + n * rec_size + len_pos, strides=(rec_size,))
+            mismatch = np.flatnonzero(lens != md_len)
+            if len(mismatch):
+                n += int(mismatch[0])
+                break
+            n += m
+            window *= 2
+
+        chunks.append(np.array(scalar, dtype=np.int64))
+        chunks.append(cursor + rec_size * np.arange(n, dtype=np.int64))
+        scalar = []
+        cursor += n * rec_size
+        run, last_len = 0, -1
+
+    chunks.append(np.array(scalar, dtype=np.int64))
+    return np.concatenate(chunks)
+
+
+# msgpack str header size by first byte: fixstr, str8, str16, str32
+_MSGPACK_STR_HDR = np.zeros(256, dtype=np.int64)
+_MSGPACK_STR_HDR[0xa0:0xc0] = 1
+_MSGPACK_STR_HDR[0xd9], _MSGPACK_STR_HDR[0xda], _MSGPACK_STR_HDR[0xdb] = 2, 3, 5
+
+_AREA_PERIL_JSON_PREFIX = np.frombuffer(b'{"area_peril_id": ', dtype=np.uint8)
+_AREA_PERIL_MAX_DIGITS = 10
+
+
+def _decode_area_peril_ids(raw, md_starts, md_lens):
+    """
+    area_peril_id of every item's model_data.
+
+    Fast path: when every model_data is a msgpack string holding JSON that
+    starts with the same '{"area_peril_id": <int>' schema (as written by the
+    keys lookup), the integers are parsed directly from the raw bytes with
+    array operations. Otherwise the model_data are unpacked with one streaming
+    msgpack Unpacker and the JSON strings parsed with a single json.loads.
+
+    Raises ValueError if a model_data is not exactly one msgpack object (e.g.
+    empty), rather than pairing the items with the wrong area_peril_ids.
+    """
+    if len(md_starts) == 0:
+        return np.empty(0, np.int32)
+
+    area_peril_ids = _area_peril_ids_fast_path(raw, md_starts, md_lens)
+    if area_peril_ids is not None:
+        return area_peril_ids
+
+    log.info('complex_items.bin model_data does not match the default schema, using the generic decoder')
+    blob = b''.join(raw[s:s + n].tobytes() for s, n in zip(md_starts.tolist(), md_lens.tolist()))
+    unpacker = msgpack.Unpacker(io.BytesIO(blob), raw=False)
+    model_data, md_ends = [], []
+    for md in unpacker:
+        model_data.append(md)
+        md_ends.append(unpacker.tell())
+    if not np.array_equal(md_ends, np.cumsum(md_lens)):
+        # the objects don't line up with the records: find the bad record
+        for i, (start, n) in enumerate(zip(md_starts.tolist(), md_lens.tolist())):
+            try:
+                msgpack.unpackb(raw[start:start + n].tobytes(), raw=False)
+            except ValueError as e:
+                raise ValueError(f'complex_items.bin record {i}: model_data is not one msgpack object ({e})') from e
+        raise ValueError('complex_items.bin: model_data does not decode to one msgpack object per record')
+    if all(isinstance(md, str) for md in model_data):
+        model_data = json.loads('[' + ','.join(model_data) + ']')
+    else:
+        model_data = [json.loads(md) if isinstance(md, str) else md for md in model_data]
+    return np.array([md.get('area_peril_id', 0) for md in model_data], np.int32)
+
+
+def _area_peril_ids_fast_path(raw, md_starts, md_lens):
+    """Vectorised area_peril_id parse for the shared JSON schema, or None if it doesn't apply."""
+    str_hdr = _MSGPACK_STR_HDR[raw[md_starts]]
+    if not np.all(str_hdr):
+        return None
+
+    prefix_len = len(_AREA_PERIL_JSON_PREFIX)
+    width = prefix_len + _AREA_PERIL_MAX_DIGITS + 1
+    json_starts = md_starts + str_hdr
+    if np.any(str_hdr + width > md_lens):
+        return None
+
+    window = np.empty((len(md_starts), width), dtype=np.uint8)
+    for j in range(width):
+        window[:, j] = raw[json_starts + j]
+
+    if not np.all(window[:, :prefix_len] == _AREA_PERIL_JSON_PREFIX):
+        return None
+
+    digits = window[:, prefix_len:].astype(np.int64) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    n_digits = np.argmin(is_digit, axis=1)   # first non-digit
+    if np.any(n_digits == 0) or np.any(is_digit.all(axis=1)):
+        return None
+    terminator = window[np.arange(len(window)), prefix_len + n_digits]
+    if not np.all((terminator == ord(',')) | (terminator == ord('}'))):
+        return None
+
+    values = np.zeros(len(window), dtype=np.int64)
+    for j in range(_AREA_PERIL_MAX_DIGITS):
+        in_number = j < n_digits
+        values = np.where(in_number, values * 10 + digits[:, j], values)
+    if values.max() > np.iinfo(np.int32).max:
+        return None
+    return values.astype(np.int32)
+
+
+def read_model_inputs(inputs_dir, static_dir, complex_items_filename, use_items_cache=True):
+    """
+    Load everything derived from the analysis inputs that is the same for every
+    event batch.
 
-    item_ids, coverage_ids, group_ids, area_peril_ids = [], [], [], []
-    cursor = 0
-    while cursor + hdr_size <= len(raw):
-        hdr = raw[cursor:cursor + hdr_size].view(_ITEM_HDR_DTYPE)[0]
-        cursor += hdr_size
-
-        md_bytes = raw[cursor:cursor + hdr['model_data_len']].tobytes()
-        cursor += hdr['model_data_len']
-
-        md = msgpack.unpackb(md_bytes, raw=False)
-        if isinstance(md, str):
-            md = json.loads(md)
-
-        item_ids.append(hdr['item_id'])
-        coverage_ids.append(hdr['coverage_id'])
-        group_ids.append(hdr['group_id'])
-        area_peril_ids.append(md.get('area_peril_id', 0))
-
-    return (
-        np.array(item_ids, np.int32),
-        np.array(coverage_ids, np.uint32),
-        np.array(group_ids, np.uint32),
-        np.array(area_peril_ids, np.int32),
+    Returns a dict of arrays (see _SHARED_CACHE_ARRAYS):
+      item_id, group_id, area_peril_id — per item, from complex_items.bin
+      item_tiv      — per item TIV, looked up from coverages.bin
+      event_id      — all events in shuffled batch order
+    """
+    item_ids, coverage_ids, group_ids, area_peril_ids = read_complex_items(
+        inputs_dir, complex_items_filename, use_cache=use_items_cache
     )
+    coverages = np.fromfile(os.path.join(static_dir, 'coverages.bin'), dtype=_COVERAGES_DTYPE)
+    all_events = read_event_ids(inputs_dir)
+
+    return {
+        'item_id': item_ids,
+        'group_id': group_ids,
+        'area_peril_id': area_peril_ids,
+        'item_tiv': coverages[coverage_ids - 1],   # coverage_ids are 1-based
+        'event_id': shuffle_events(all_events),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Shared per-analysis cache
+# ---------------------------------------------------------------------------
+#
+# Every `-e n m` batch of an analysis needs the same item arrays and event
+# order. prepare_shared_cache() writes them once as .npy files into
+# <inputs>/complex_model_cache, and each batch memory-maps them read-only.
+# The manifest records the size/mtime of the source files so a cache left
+# over from different inputs is rebuilt rather than reused.
+
+SHARED_CACHE_DIRNAME = 'complex_model_cache'
+_SHARED_CACHE_LOCK = f'.{SHARED_CACHE_DIRNAME}.lock'
+_SHARED_CACHE_VERSION = 1
+_SHARED_CACHE_ARRAYS = ('item_id', 'group_id', 'area_peril_id', 'item_tiv', 'event_id')
+
+
+def _shared_cache_sources(inputs_dir, static_dir, complex_items_filename):
+    sources = {
+        'complex_items': os.path.join(inputs_dir, complex_items_filename),
+        'coverages': os.path.join(static_dir, 'coverages.bin'),
+        'events': os.path.join(inputs_dir, 'events.bin'),
+    }
+    manifest = {'version': _SHARED_CACHE_VERSION}
+    for name, path in sources.items():
+        st = os.stat(path)
+        manifest[name] = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    return manifest
+
+
+def _read_shared_cache_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prepare_shared_cache(inputs_dir, static_dir=None, complex_items_filename='complex_items.bin'):
+    """
+    Build the shared cache for an analysis, unless an up to date one exists.
+
+    The cache is written to a temporary directory and renamed into place, so
+    batches started concurrently either see a complete cache or none. The
+    rename is done under a lock, after checking the manifest again: a batch
+    that finds an up to date cache put there by another batch in the
+    meantime discards its own, so a cache in use is only ever replaced when
+    it is stale.
+
+    Returns the cache directory path.
+    """
+    if static_dir is None:
+        static_dir = os.path.join(os.path.dirname(os.path.abspath(inputs_dir)), 'static')
+    cache_dir = os.path.join(inputs_dir, SHARED_CACHE_DIRNAME)
+    manifest = _shared_cache_sources(inputs_dir, static_dir, complex_items_filename)
+    if _read_shared_cache_manifest(cache_dir) == manifest:
+        return cache_dir
+
+    log.info(f'Preparing shared model cache in {cache_dir}...')
+    model_inputs = read_model_inputs(inputs_dir, static_dir, complex_items_filename, use_items_cache=False)
+
+    tmp_dir = tempfile.mkdtemp(prefix=f'.{SHARED_CACHE_DIRNAME}.', dir=inputs_dir)
+    try:
+        os.chmod(tmp_dir, 0o755)
+        for name in _SHARED_CACHE_ARRAYS:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), model_inputs[name])
+        # manifest last: its presence marks the cache as complete
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        with open(os.path.join(inputs_dir, _SHARED_CACHE_LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if _read_shared_cache_manifest(cache_dir) == manifest:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return cache_dir
+            if os.path.isdir(cache_dir):
+                stale_dir = tempfile.mkdtemp(prefix=f'.{SHARED_CACHE_DIRNAME}.stale.', dir=inputs_dir)
+                os.replace(cache_dir, os.path.join(stale_dir, SHARED_CACHE_DIRNAME))
+                shutil.rmtree(stale_dir, ignore_errors=True)
+            os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another batch finished first; use its cache if it matches ours
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if _read_shared_cache_manifest(cache_dir) != manifest:
+            raise
+    return cache_dir
+
+
+def attach_shared_cache(inputs_dir, static_dir, complex_items_filename):
+    """
+    Memory-map the shared cache arrays read-only, preparing the cache first if
+    it is missing or stale. Returns the same dict as read_model_inputs().
+    """
+    cache_dir = prepare_shared_cache(inputs_dir, static_dir, complex_items_filename)
+    return {
+        name: np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r')
+        for name in _SHARED_CACHE_ARRAYS
+    }
 
 
-def load_footprint(static_dir):
+# ---------------------------------------------------------------------------
+# Footprint
+# ---------------------------------------------------------------------------
+
+def load_footprint(static_dir, use_mmap=True, cache_size=64):
     """
     Memory-map footprint.bin and load the index from footprint.idx.
 
+    If there is no footprint.bin but a footprint.bin.z/footprint.idx.z pair is
+    present (csvtobin footprint -z), the compressed footprint is loaded instead
+    and events are decompressed on demand — see CompressedFootprint.
+
     footprint.bin layout:
       [num_intensity_bins (i4), has_intensity_uncertainty (i4)]   <- 8-byte header
       [areaperil_id (u4), intensity_bin_id (i4), probability (f4)] * N
@@ -131,33 +493,149 @@ def load_footprint(static_dir):
       [event_id (i4), offset (i8), size (i8)] * M
       where offset/size are byte positions in footprint.bin.
 
-    Returns (fp_data, fp_idx_map, num_intensity_bins):
-      fp_data       — full footprint record array
-      fp_idx_map    — dict event_id -> index entry
+    With use_mmap (the default) both files are mapped read-only, so the pages
+    are shared through the OS page cache by every batch process on the node
+    and startup cost does not depend on footprint size. Without it the
+    records are read into private memory.
+
+    Returns (fp_data, fp_idx, num_intensity_bins):
+      fp_data       — full footprint record array, or a CompressedFootprint
+      fp_idx        — index record array, sorted by event_id
       num_intensity_bins — number of intensity bins (for normalisation)
     """
-    with open(os.path.join(static_dir, 'footprint.bin'), 'rb') as f:
-        num_intensity_bins = struct.unpack('<i', f.read(4))[0]
-        f.read(4)
-        fp_data = np.frombuffer(f.read(), dtype=_FP_RECORD_DTYPE).copy()
+    fp_bin_path, fp_idx_path, compressed = _footprint_paths(static_dir)
+
+    with open(fp_bin_path, 'rb') as f:
+        num_intensity_bins, fp_flags = struct.unpack('<ii', f.read(_FP_HEADER_SIZE))
+        if not use_mmap:
+            raw = f.read()
+
+    if compressed:
+        idx_dtype = _FP_IDX_Z_DTYPE if fp_flags & _FP_UNCOMPRESSED_SIZE_FLAG else _FP_IDX_DTYPE
+        zdata = _memmap_records(fp_bin_path, np.uint8) if use_mmap else np.frombuffer(raw, np.uint8)
+        # keep byte offsets relative to the start of the file, as in the index
+        fp_data = CompressedFootprint(zdata, 0 if use_mmap else _FP_HEADER_SIZE, cache_size)
+    else:
+        idx_dtype = _FP_IDX_DTYPE
+        if use_mmap:
+            fp_data = _memmap_records(fp_bin_path, _FP_RECORD_DTYPE, offset=_FP_HEADER_SIZE)
+        else:
+            fp_data = np.frombuffer(raw, dtype=_FP_RECORD_DTYPE).copy()
+
+    fp_idx = _memmap_records(fp_idx_path, idx_dtype) if use_mmap else np.fromfile(fp_idx_path, dtype=idx_dtype)
+
+    # footprint.idx is written in event_id order by the ktools tools, so this
+    # is normally a no-op check rather than a sort.
+    if np.any(np.diff(fp_idx['event_id']) < 0):
+        fp_idx = fp_idx[np.argsort(fp_idx['event_id'], kind='stable')]
+
+    return fp_data, fp_idx, num_intensity_bins
+
+
+def _footprint_paths(static_dir):
+    """(bin path, idx path, compressed) of the footprint in static_dir."""
+    fp_bin_path = os.path.join(static_dir, 'footprint.bin')
+    fp_idx_path = os.path.join(static_dir, 'footprint.idx')
+    if not os.path.exists(fp_bin_path) and os.path.exists(fp_bin_path + '.z'):
+        return fp_bin_path + '.z', fp_idx_path + '.z', True
+    return fp_bin_path, fp_idx_path, False
+
+
+def _memmap_records(path, dtype, offset=0):
+    """
+    Read-only memory map of a flat record file, starting at byte offset.
 
-    fp_idx = np.fromfile(os.path.join(static_dir, 'footprint.idx'), dtype=_FP_IDX_DTYPE)
-    fp_idx_map = {int(r['event_id']): r for r in fp_idx}
+    np.memmap refuses zero-length maps, so an empty record section is
+    returned as an empty array instead.
+    """
+    if os.path.getsize(path) <= offset:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset)
 
-    return fp_data, fp_idx_map, num_intensity_bins
 
+class CompressedFootprint:
+    """
+    Event records from a zlib-compressed footprint.bin.z, inflated on demand.
 
-def event_intensity_by_areaperil(fp_data, fp_idx_entry, num_intensity_bins):
+    Each event is a separately compressed block; the most recently used
+    decompressed events are kept in a bounded LRU cache so that the full
+    footprint is never inflated into memory (or onto disk).
+    """
+
+    def __init__(self, zdata, base_offset, cache_size):
+        self.zdata = zdata
+        self.base_offset = base_offset
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def read(self, offset, size):
+        """Decompressed records of the block at byte offset/size in footprint.bin.z."""
+        records = self._cache.get(offset)
+        if records is not None:
+            self._cache.move_to_end(offset)
+            return records
+
+        start = offset - self.base_offset
+        records = np.frombuffer(zlib.decompress(self.zdata[start:start + size]), dtype=_FP_RECORD_DTYPE)
+        if self.cache_size > 0:
+            self._cache[offset] = records
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return records
+
+
+def resolve_event_slices(fp_idx, event_ids, compressed=False):
+    """
+    Look up the footprint record range of every event in the batch at once.
+
+    Events are matched against the sorted fp_idx event_ids with a single
+    searchsorted call; events with no footprint entry are dropped. Batch
+    order is preserved.
+
+    Returns (event_ids, starts, counts) — parallel arrays, where starts and
+    counts are record (not byte) positions in fp_data. With compressed set
+    they are instead the byte offset and size of each event's block in
+    footprint.bin.z, as taken by CompressedFootprint.read().
+    """
+    event_ids, entries = _match_event_index(fp_idx, event_ids)
+    if compressed:
+        return event_ids, entries['offset'].astype(np.int64), entries['size'].astype(np.int64)
+
+    rec_size = _FP_RECORD_DTYPE.itemsize
+    starts = (entries['offset'] - _FP_HEADER_SIZE) // rec_size
+    counts = entries['size'] // rec_size
+    return event_ids, starts, counts
+
+
+def _match_event_index(idx, event_ids):
+    """
+    (event_ids, entries) for the events present in an index sorted by
+    event_id, in the order given.
+    """
+    event_ids = np.asarray(event_ids, dtype=np.int32)
+    if len(idx) == 0:
+        return event_ids[:0], idx[:0]
+
+    pos = np.searchsorted(idx['event_id'], event_ids)
+    pos = np.clip(pos, 0, len(idx) - 1)
+    found = idx['event_id'][pos] == event_ids
+    return event_ids[found], idx[pos[found]]
+
+
+def event_intensity_by_areaperil(fp_data, start, n, num_intensity_bins):
     """
     For one event, compute probability-weighted mean intensity per areaperil_id,
     normalised to [0, 1].
 
+    start and n are the event's range in fp_data, as returned by
+    resolve_event_slices().
+
     Returns (ap_ids, intensities) — parallel sorted arrays.
     """
-    rec_size = _FP_RECORD_DTYPE.itemsize
-    start = (int(fp_idx_entry['offset']) - _FP_HEADER_SIZE) // rec_size
-    n = int(fp_idx_entry['size']) // rec_size
-    records = fp_data[start:start + n]
+    if isinstance(fp_data, CompressedFootprint):
+        records = fp_data.read(start, n)
+    else:
+        records = fp_data[start:start + n]
 
     if records.size == 0:
         return np.empty(0, np.uint32), np.empty(0, np.float32)
@@ -169,26 +647,242 @@ def event_intensity_by_areaperil(fp_data, fp_idx_entry, num_intensity_bins):
     return ap_ids, (weighted / num_intensity_bins).astype(np.float32)
 
 
-def map_intensity_to_items(area_peril_ids, ap_ids, intensities):
+# ---------------------------------------------------------------------------
+# Precomputed intensity table
+# ---------------------------------------------------------------------------
+#
+# The per-event reduction in event_intensity_by_areaperil() only depends on
+# static model data, so it can be done once per footprint and stored in CSR
+# form next to it:
+#
+#   footprint_intensity.bin:
+#     [version (i4), num_events (i4),                        <- header
+#      bin_size (i8), bin_mtime_ns (i8), idx_size (i8), idx_mtime_ns (i8)]
+#     [areaperil_id (u4), intensity (f4)] * N                <- all events, in event_id order
+#
+#   footprint_intensity.idx:
+#     [event_id (i4), offset (i8), count (i8)] * num_events
+#     where offset/count are record positions in footprint_intensity.bin.
+#
+# The header identifies the footprint files the table was built from by their
+# sizes and modification times. A table is only used when both still match,
+# so checking it never reads the footprint; otherwise it is ignored with a
+# warning to rebuild it. Copying model data without preserving modification
+# times (plain cp, a fresh git checkout) therefore needs the table rebuilt,
+# or copied with cp -p / rsync -t along with the footprint.
+
+INTENSITY_TABLE_FILENAME = 'footprint_intensity.bin'
+INTENSITY_INDEX_FILENAME = 'footprint_intensity.idx'
+
+
+def _footprint_stats(static_dir):
+    """(bin size, bin mtime, idx size, idx mtime) of the footprint files, following symlinks."""
+    fp_bin_path, fp_idx_path, _ = _footprint_paths(static_dir)
+    bin_st, idx_st = os.stat(fp_bin_path), os.stat(fp_idx_path)
+    return bin_st.st_size, bin_st.st_mtime_ns, idx_st.st_size, idx_st.st_mtime_ns
+
+
+def write_intensity_table(static_dir, use_mmap=True):
+    """
+    Precompute the sorted (areaperil_id, mean_intensity) arrays of every
+    footprint event and write them as footprint_intensity.bin/.idx in
+    static_dir. Events are processed one at a time, so memory use does not
+    depend on footprint size.
+
+    Returns the number of events written.
+    """
+    _, _, compressed = _footprint_paths(static_dir)
+    fp_data, fp_idx, num_intensity_bins = load_footprint(static_dir, use_mmap=use_mmap, cache_size=0)
+    event_ids, starts, counts = resolve_event_slices(fp_idx, fp_idx['event_id'], compressed=compressed)
+
+    table_path = os.path.join(static_dir, INTENSITY_TABLE_FILENAME)
+    index_path = os.path.join(static_dir, INTENSITY_INDEX_FILENAME)
+    table_idx = np.empty(len(event_ids), dtype=_INTENSITY_IDX_DTYPE)
+    table_idx['event_id'] = event_ids
+
+    header = np.zeros(1, dtype=_INTENSITY_HEADER_DTYPE)
+    header['version'] = _INTENSITY_VERSION
+    header['num_events'] = len(event_ids)
+    (header['bin_size'], header['bin_mtime_ns'],
+     header['idx_size'], header['idx_mtime_ns']) = _footprint_stats(static_dir)
+
+    offset = 0
+    with open(table_path + '.tmp', 'wb') as f:
+        f.write(header.tobytes())
+        for k, (start, n) in enumerate(zip(starts.tolist(), counts.tolist())):
+            ap_ids, intensities = event_intensity_by_areaperil(fp_data, start, n, num_intensity_bins)
+            records = np.empty(len(ap_ids), dtype=_INTENSITY_RECORD_DTYPE)
+            records['areaperil_id'] = ap_ids
+            records['intensity'] = intensities
+            f.write(records.tobytes())
+            table_idx[k]['offset'] = offset
+            table_idx[k]['count'] = len(records)
+            offset += len(records)
+    table_idx.tofile(index_path + '.tmp')
+
+    os.replace(table_path + '.tmp', table_path)
+    os.replace(index_path + '.tmp', index_path)
+    return len(event_ids)
+
+
+def load_intensity_table(static_dir, use_mmap=True):
+    """
+    Load footprint_intensity.bin/.idx from static_dir.
+
+    Returns (table, table_idx), or None when there is no table or it was
+    built from a different footprint (see the header description above).
+    """
+    table_path = os.path.join(static_dir, INTENSITY_TABLE_FILENAME)
+    index_path = os.path.join(static_dir, INTENSITY_INDEX_FILENAME)
+    if not (os.path.exists(table_path) and os.path.exists(index_path)):
+        return None
+
+    header = np.fromfile(table_path, dtype=_INTENSITY_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header[0]['version'] != _INTENSITY_VERSION:
+        log.warning(f'Ignoring {table_path}: unknown table version, rebuild it')
+        return None
+    header = header[0]
+
+    fp_bin_path, fp_idx_path, _ = _footprint_paths(static_dir)
+    if not (os.path.exists(fp_bin_path) and os.path.exists(fp_idx_path)):
+        log.warning(f'Ignoring {table_path}: no footprint to check it against')
+        return None
+    built_from = (header['bin_size'], header['bin_mtime_ns'], header['idx_size'], header['idx_mtime_ns'])
+    if built_from != _footprint_stats(static_dir):
+        log.warning(f'Ignoring {table_path}: the footprint size or modification time has changed since it was '
+                    f'built, rebuild it')
+        return None
+
+    hdr_size = _INTENSITY_HEADER_DTYPE.itemsize
+    if use_mmap:
+        table = _memmap_records(table_path, _INTENSITY_RECORD_DTYPE, offset=hdr_size)
+        table_idx = _memmap_records(index_path, _INTENSITY_IDX_DTYPE)
+    else:
+        table = np.fromfile(table_path, dtype=_INTENSITY_RECORD_DTYPE, offset=hdr_size)
+        table_idx = np.fromfile(index_path, dtype=_INTENSITY_IDX_DTYPE)
+    return table, table_idx
+
+
+def resolve_intensity_slices(table_idx, event_ids):
+    """Like resolve_event_slices(), for the record ranges of the intensity table."""
+    event_ids, entries = _match_event_index(table_idx, event_ids)
+    return event_ids, entries['offset'].astype(np.int64), entries['count'].astype(np.int64)
+
+
+def build_areaperil_item_index(area_peril_ids):
+    """
+    CSR-style inverted index from area_peril_id to item rows, built once per batch.
+
+    Returns (ap_ids, offsets, item_rows): the items with area_peril_id
+    ap_ids[k] are item_rows[offsets[k]:offsets[k + 1]], in ascending row order.
+    """
+    item_rows = np.argsort(area_peril_ids, kind='stable')
+    ap_ids, counts = np.unique(area_peril_ids[item_rows], return_counts=True)
+    offsets = np.zeros(len(ap_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return ap_ids.astype(np.int64), offsets, item_rows
+
+
+def map_intensity_to_items(ap_index, ap_ids, intensities):
     """
-    Vectorised lookup: for each item's area_peril_id find its event intensity.
+    Find the items hit by one event, using the areaperil inverted index.
+
+    Only the index entries of the event's areaperils with non-zero intensity
+    are visited, so the cost scales with the affected exposure rather than
+    with portfolio size.
 
-    Uses searchsorted on the sorted ap_ids array returned by np.unique.
-    Items whose area_peril_id is not in ap_ids get intensity 0.
+    Returns (rows, item_intensities) — the affected item rows in ascending
+    order and their event intensity.
     """
-    pos = np.searchsorted(ap_ids, area_peril_ids)
-    pos = np.clip(pos, 0, len(ap_ids) - 1)
-    found = ap_ids[pos] == area_peril_ids
-    return np.where(found, intensities[pos], 0.0).astype(np.float32)
+    index_ap_ids, offsets, item_rows = ap_index
+    if len(index_ap_ids) == 0 or len(ap_ids) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.float32)
+
+    ap_ids = ap_ids.astype(np.int64)
+    pos = np.searchsorted(index_ap_ids, ap_ids)
+    pos = np.clip(pos, 0, len(index_ap_ids) - 1)
+    hit = (index_ap_ids[pos] == ap_ids) & (intensities > 0)
+    pos = pos[hit]
+
+    starts = offsets[pos]
+    counts = offsets[pos + 1] - starts
+    # gather all the [start, start + count) ranges in one go
+    run_starts = np.cumsum(counts) - counts
+    gather = np.arange(counts.sum()) + np.repeat(starts - run_starts, counts)
+
+    rows = item_rows[gather]
+    item_intensities = np.repeat(intensities[hit], counts)
+    order = np.argsort(rows)
+    return rows[order], item_intensities[order].astype(np.float32)
 
 
 # ---------------------------------------------------------------------------
 # GUL calculation
 # ---------------------------------------------------------------------------
 
-def compute_guls(event_id, group_ids, tivs, intensity_fracs, n_samples):
+# Random numbers are drawn in float64 (as Generator.uniform produces them) and
+# stored as float32 this many values at a time, so the float64 copy of the
+# matrix never exists in full.
+_RAND_BLOCK_VALUES = 1 << 16
+
+
+class GroupRandomNumbers:
+    """
+    The random numbers of one event's active items.
+
+    One row of n_samples uniforms belongs to each unique group_id, in sorted
+    group order, all taken from a single stream seeded by event_id, so items
+    in the same group share their samples. A production model would use
+    per-group MT19937 seeding for full correlation control.
+
+    Rows are only drawn for the items of one chunk at a time (see rows()),
+    jumping ahead in the stream to each run of consecutive groups, so memory
+    use depends on the chunk size rather than on the number of groups in the
+    event.
+    """
+
+    def __init__(self, event_id, group_ids, n_samples):
+        _, self.group_rows = np.unique(group_ids, return_inverse=True)
+        self.n_samples = n_samples
+        self.bit_generator = np.random.PCG64(event_id)
+        self.generator = np.random.Generator(self.bit_generator)
+        self.initial_state = self.bit_generator.state
+        self.position = 0   # values drawn from the stream so far
+
+    def _seek(self, position):
+        # every float64 uniform takes one step of the PCG64 stream
+        if position < self.position:
+            self.bit_generator.state = self.initial_state
+            self.position = 0
+        if position > self.position:
+            self.bit_generator.advance(position - self.position)
+            self.position = position
+
+    def rows(self, items):
+        """
+        rand_matrix (one float32 row per group used by items) and rand_rows,
+        the row of rand_matrix to use for each of items (a slice or index
+        array into the event's active items).
+        """
+        needed, rand_rows = np.unique(self.group_rows[items], return_inverse=True)
+        rand_matrix = np.empty((len(needed), self.n_samples), dtype=np.float32)
+
+        # draw each run of consecutive groups from its position in the stream,
+        # in float64 blocks of _RAND_BLOCK_VALUES
+        step = max(1, _RAND_BLOCK_VALUES // max(self.n_samples, 1))
+        breaks = np.flatnonzero(np.diff(needed) != 1) + 1
+        for run_start, run_end in zip(np.r_[0, breaks].tolist(), np.r_[breaks, len(needed)].tolist()):
+            self._seek(int(needed[run_start]) * self.n_samples)
+            for row in range(run_start, run_end, step):
+                n_rows = min(step, run_end - row)
+                rand_matrix[row:row + n_rows] = self.generator.uniform(size=(n_rows, self.n_samples))
+                self.position += n_rows * self.n_samples
+        return rand_matrix, rand_rows
+
+
+def compute_guls(rand_matrix, rand_rows, tivs, intensity_fracs, sample_out, mean_out, std_out):
     """
-    Vectorised GUL calculation for all active items in one event.
+    Vectorised GUL calculation for a chunk of active items in one event.
 
     Simple loss model:
       sample = intensity_frac * U[0,1] * tiv
@@ -198,36 +892,46 @@ def compute_guls(event_id, group_ids, tivs, intensity_fracs, n_samples):
 
     All samples are capped at TIV.
 
-    Random numbers are generated in a single vectorised call seeded by event_id
-    (one stream per unique group_id). A production model would use per-group
-    MT19937 seeding for full correlation control.
-
-    Returns sample_losses (n_items × n_samples), mean_losses (n_items,),
-            std_losses (n_items,).
+    rand_matrix and rand_rows come from GroupRandomNumbers.rows() for the
+    items of this chunk, which tivs and intensity_fracs also cover. Results are
+    written into sample_out (n_items × n_samples), mean_out and std_out
+    (n_items,), which may be strided views such as the columns of a
+    GulStreamWriter buffer. Every step is a float32 ufunc writing in place,
+    so no float64 intermediates or item-sized temporaries are created.
     """
-    unique_gids, inv = np.unique(group_ids, return_inverse=True)
-    rand_matrix = np.random.default_rng(event_id).uniform(
-        size=(len(unique_gids), n_samples)
-    ).astype(np.float32)
-
-    item_rands = rand_matrix[inv]                                           # (n_items, n_samples)
     f = intensity_fracs[:, np.newaxis]                                      # (n_items, 1)
     t = tivs[:, np.newaxis]                                                 # (n_items, 1)
 
-    sample_losses = np.minimum(f * item_rands * t, t).astype(np.float32)   # (n_items, n_samples)
-    mean_losses = (intensity_fracs * tivs).astype(np.float32)
-    std_losses = (tivs * np.sqrt(np.maximum(intensity_fracs / 3.0, 0))).astype(np.float32)
+    np.take(rand_matrix, rand_rows, axis=0, out=sample_out)                 # (n_items, n_samples)
+    np.multiply(sample_out, f, out=sample_out)
+    np.multiply(sample_out, t, out=sample_out)
+    np.minimum(sample_out, t, out=sample_out)
 
-    return sample_losses, mean_losses, std_losses
+    np.multiply(intensity_fracs, tivs, out=mean_out)
+
+    np.divide(intensity_fracs, np.float32(3.0), out=std_out)
+    np.maximum(std_out, np.float32(0.0), out=std_out)
+    np.sqrt(std_out, out=std_out)
+    np.multiply(std_out, tivs, out=std_out)
+
+
+def items_per_chunk(n_samples, memory_budget):
+    """
+    Number of items to compute at once so that one chunk's output rows and
+    random numbers (at most one row per item) fit in memory_budget bytes (at
+    least one item).
+    """
+    row_bytes = 4 * (2 + 2 * (3 + n_samples + 1)) + 4 * n_samples
+    return max(1, memory_budget // row_bytes)
 
 
 # ---------------------------------------------------------------------------
 # Binary stream output
 # ---------------------------------------------------------------------------
 
-def write_event_to_stream(out, event_id, item_ids, tivs, mean_losses, std_losses, sample_losses):
+class GulStreamWriter:
     """
-    Write one event's GUL records to the output stream.
+    Writes GUL records to the output stream from one reusable buffer.
 
     Per-item binary layout (all fields 4 bytes, little-endian):
       event_id (i4)  item_id (i4)
@@ -238,34 +942,151 @@ def write_event_to_stream(out, event_id, item_ids, tivs, mean_losses, std_losses
       ...
       sidx=n  (i4)   sample_n (f4)
       0       (i4)   0.0 (f4)          <- terminator
+
+    The buffer holds one row per item in that layout. The sidx and terminator
+    columns are the same for every row, so they are filled once when the
+    buffer is allocated. add_rows() fills the id columns of the next rows and
+    returns views of their loss columns for the caller to compute into.
+    Rows accumulate until the buffer holds at least flush_bytes, then they are
+    handed to out.write() as one memoryview; with flush_bytes=0 each call's
+    rows are written before the next call adds more. The buffer grows to fit
+    the largest single add_rows() call.
+    """
+
+    def __init__(self, out, n_samples, flush_bytes=0):
+        self.out = out
+        self.n_samples = n_samples
+        self.flush_bytes = flush_bytes
+        n_pairs = 3 + n_samples + 1     # sidx=-3,-2,-1, 1..n, terminator
+        self.row_width = 2 + 2 * n_pairs
+        self.sidxs = np.array([-3, -2, -1] + list(range(1, n_samples + 1)) + [0], dtype='<i4')
+        self.buf = np.empty((0, self.row_width), dtype='<i4')
+        self.losses = self.buf.view('<f4')[:, 3::2]
+        self.n_rows = 0
+
+    def _reserve(self, n_items):
+        """Make room for n_items more rows, flushing or growing the buffer as needed."""
+        if 4 * self.row_width * self.n_rows >= self.flush_bytes:
+            self.flush()
+        if self.n_rows + n_items <= len(self.buf):
+            return
+        self.flush()
+        if n_items <= len(self.buf):
+            return
+        row_bytes = 4 * self.row_width
+        capacity = max(n_items, self.flush_bytes // row_bytes + 1)
+        buf = np.empty((capacity, self.row_width), dtype='<i4')
+        buf[:, 2::2] = self.sidxs
+        buf[:, -1] = 0
+        self.buf = buf
+        self.losses = buf.view('<f4')[:, 3::2]    # tiv, std, mean, samples..., terminator
+
+    def add_rows(self, event_id, item_ids):
+        """
+        Add rows for the given items of one event.
+
+        Returns views (tivs, std_losses, mean_losses, sample_losses) of the
+        new rows' loss columns; the caller must fill all of them before the
+        next add_rows() or flush().
+        """
+        n_items = len(item_ids)
+        self._reserve(n_items)
+        rows = slice(self.n_rows, self.n_rows + n_items)
+        self.buf[rows, 0] = event_id
+        self.buf[rows, 1] = item_ids
+        self.n_rows += n_items
+
+        losses = self.losses[rows]
+        return losses[:, 0], losses[:, 1], losses[:, 2], losses[:, 3:3 + self.n_samples]
+
+    def flush(self):
+        """Write the buffered rows to the output stream."""
+        if self.n_rows:
+            self.out.write(memoryview(self.buf[:self.n_rows]).cast('B'))
+            self.n_rows = 0
+
+
+# ---------------------------------------------------------------------------
+# Event processing
+# ---------------------------------------------------------------------------
+
+def process_event(state, event_id, start, n, writer):
+    """
+    Compute one event's GULs and add them to writer (a GulStreamWriter).
+
+    state holds everything shared by the events of a batch (see main());
+    start and n are the event's range in the intensity table or footprint.
+    Items are computed directly into the writer's buffer, at most
+    state['chunk_items'] at a time.
     """
-    n_items = len(item_ids)
-    n_samples = sample_losses.shape[1]
-    n_pairs = 3 + n_samples + 1     # sidx=-3,-2,-1, 1..n, terminator
+    if state['intensity_table'] is not None:
+        records = state['intensity_table'][start:start + n]
+        ap_ids, intensities = records['areaperil_id'], records['intensity']
+    else:
+        ap_ids, intensities = event_intensity_by_areaperil(
+            state['fp_data'], start, n, state['num_intensity_bins']
+        )
+    active, item_intensities = map_intensity_to_items(state['ap_index'], ap_ids, intensities)
+    if len(active) == 0:
+        return
+
+    random_numbers = GroupRandomNumbers(event_id, state['group_ids'][active], state['n_samples'])
+    chunk_items = state['chunk_items']
+    for i in range(0, len(active), chunk_items):
+        chunk = slice(i, i + chunk_items)
+        rows = active[chunk]
+        tiv_out, std_out, mean_out, sample_out = writer.add_rows(event_id, state['item_ids'][rows])
+        item_tivs = state['item_tivs'][rows]
+        tiv_out[:] = item_tivs
+        rand_matrix, rand_rows = random_numbers.rows(chunk)
+        compute_guls(
+            rand_matrix, rand_rows, item_tivs, item_intensities[chunk],
+            sample_out, mean_out, std_out,
+        )
 
-    sidxs = np.array([-3, -2, -1] + list(range(1, n_samples + 1)) + [0], dtype='<i4')
 
-    # losses_matrix: (n_items, n_pairs) — tiv, std, mean, samples..., 0.0
-    losses_matrix = np.hstack([
-        tivs[:, np.newaxis],
-        std_losses[:, np.newaxis],
-        mean_losses[:, np.newaxis],
-        sample_losses,
-        np.zeros((n_items, 1), dtype=np.float32),
-    ]).astype('<f4')
+# Batch state inherited by forked worker processes. Everything large in it is
+# memory-mapped, so workers share the pages with the parent rather than copies.
+_worker_state = None
+_worker_writer = None
 
-    # Interleave sidx (i4) and loss (f4) columns as raw u4 bytes
-    interleaved = np.empty((n_items, 2 * n_pairs), dtype='<u4')
-    interleaved[:, 0::2] = sidxs.view('<u4')
-    interleaved[:, 1::2] = losses_matrix.view('<u4')
+_EVENTS_PER_TASK = 8
 
-    # Prepend event_id and item_id header columns
-    headers = np.empty((n_items, 2), dtype='<i4')
-    headers[:, 0] = event_id
-    headers[:, 1] = item_ids
 
-    full = np.hstack([headers.view('<u4'), interleaved])
-    out.write(full.tobytes())
+def _process_events_in_worker(tasks):
+    """Run a group of events in a worker and return their output bytes."""
+    global _worker_writer
+    if _worker_writer is None:
+        _worker_writer = GulStreamWriter(None, _worker_state['n_samples'])
+    _worker_writer.out = io.BytesIO()
+    for event_id, start, n in tasks:
+        process_event(_worker_state, event_id, start, n, _worker_writer)
+    _worker_writer.flush()
+    return _worker_writer.out.getvalue()
+
+
+def process_events_parallel(state, events, out, workers):
+    """
+    Spread events over a pool of forked worker processes.
+
+    Events are sent in small groups, and results are written to out in the
+    original event order, so the stream is byte-identical to the serial path.
+    At most a few groups per worker are in flight, which bounds the memory
+    held by buffered results.
+    """
+    global _worker_state
+    _worker_state = state
+    tasks = [events[i:i + _EVENTS_PER_TASK] for i in range(0, len(events), _EVENTS_PER_TASK)]
+    max_pending = 4 * workers
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_process_events_in_worker, (task,)))
+            if len(pending) >= max_pending:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
 
 
 # ---------------------------------------------------------------------------
@@ -286,51 +1107,55 @@ def main():
         n_samples = settings['number_of_samples']
 
     log.info('Loading complex items...')
-    item_ids, coverage_ids, group_ids, area_peril_ids = read_complex_items(
-        inputs_dir, args.complex_items_filename
-    )
-
-    coverages = np.fromfile(os.path.join(static_dir, 'coverages.bin'), dtype=_COVERAGES_DTYPE)
-    item_tivs = coverages[coverage_ids - 1]   # coverage_ids are 1-based
-
-    # Batch selection: shuffle all events with fixed seed then slice, matching
-    # the behaviour of the original implementation for reproducibility.
-    all_events = np.fromfile(os.path.join(inputs_dir, 'events.bin'), dtype=_EVENTS_DTYPE)['event_id']
-    np.random.seed(1234)
-    shuffled = np.random.choice(all_events, len(all_events), replace=False)
-    chunk = int(np.ceil(len(shuffled) / max_event_batch))
-    batch = shuffled[(event_batch - 1) * chunk: min(event_batch * chunk, len(shuffled))]
+    if args.use_shared_cache:
+        model_inputs = attach_shared_cache(inputs_dir, static_dir, args.complex_items_filename)
+    else:
+        model_inputs = read_model_inputs(
+            inputs_dir, static_dir, args.complex_items_filename, use_items_cache=args.use_items_cache
+        )
 
-    log.info('Loading footprint...')
-    fp_data, fp_idx_map, num_intensity_bins = load_footprint(static_dir)
+    shuffled = model_inputs['event_id']
+    batch = shuffled[event_batch_slice(len(shuffled), event_batch, max_event_batch)]
+
+    state = {
+        'item_ids': model_inputs['item_id'],
+        'group_ids': model_inputs['group_id'],
+        'item_tivs': model_inputs['item_tiv'],
+        'ap_index': build_areaperil_item_index(model_inputs['area_peril_id']),
+        'n_samples': n_samples,
+        'chunk_items': items_per_chunk(n_samples, args.memory_budget),
+        'intensity_table': None,
+        'fp_data': None,
+        'num_intensity_bins': None,
+    }
+
+    intensity_table = load_intensity_table(static_dir, use_mmap=args.use_mmap)
+    if intensity_table is not None:
+        log.info('Loading precomputed footprint intensity table...')
+        state['intensity_table'], table_idx = intensity_table
+        batch_events, batch_starts, batch_counts = resolve_intensity_slices(table_idx, batch)
+    else:
+        log.info('Loading footprint...')
+        fp_data, fp_idx, num_intensity_bins = load_footprint(
+            static_dir, use_mmap=args.use_mmap, cache_size=args.footprint_cache_size
+        )
+        state['fp_data'], state['num_intensity_bins'] = fp_data, num_intensity_bins
+        batch_events, batch_starts, batch_counts = resolve_event_slices(
+            fp_idx, batch, compressed=isinstance(fp_data, CompressedFootprint)
+        )
+    events = list(zip(batch_events.tolist(), batch_starts.tolist(), batch_counts.tolist()))
 
     out = sys.stdout.buffer if args.loss_output_stream == '-' else open(args.loss_output_stream, 'wb')
     out.write(struct.pack('<ii', GUL_STREAM_ID, n_samples))
 
     log.info(f'Processing batch {event_batch}/{max_event_batch} ({len(batch)} events)...')
-    for event_id in batch:
-        event_id = int(event_id)
-        if event_id not in fp_idx_map:
-            continue
-
-        ap_ids, intensities = event_intensity_by_areaperil(fp_data, fp_idx_map[event_id], num_intensity_bins)
-        item_intensities = map_intensity_to_items(area_peril_ids, ap_ids, intensities)
-
-        active = item_intensities > 0
-        if not np.any(active):
-            continue
-
-        sample_losses, mean_losses, std_losses = compute_guls(
-            event_id,
-            group_ids[active], item_tivs[active], item_intensities[active],
-            n_samples,
-        )
-
-        write_event_to_stream(
-            out, event_id,
-            item_ids[active], item_tivs[active],
-            mean_losses, std_losses, sample_losses,
-        )
+    if args.workers > 1 and len(events) > 1:
+        process_events_parallel(state, events, out, args.workers)
+    else:
+        writer = GulStreamWriter(out, n_samples, flush_bytes=args.write_buffer_size)
+        for event_id, start, n in events:
+            process_event(state, event_id, start, n, writer)
+        writer.flush()
 
     if args.loss_output_stream != '-':
         out.close()
@@ -1,6 +1,8 @@
 import itertools
 import json
 
+import pandas as pd
+
 from oasislmf.utils import (
     coverages,
 )
@@ -17,6 +19,16 @@ PERILS = {
         'storm surge': 'WSS'
         }
 
+# Areaperil and vulnerability for each (peril, coverage type); every location
+# is given the same keys, with the areaperil/vulnerability pair also carried
+# in model_data for the complex gulcalc.
+KEY_DATA = {
+    (PERILS['tropical cyclone'], coverages.COVERAGE_TYPES['buildings']['id']): (54, 2),
+    (PERILS['tropical cyclone'], coverages.COVERAGE_TYPES['contents']['id']): (54, 5),
+    (PERILS['storm surge'], coverages.COVERAGE_TYPES['buildings']['id']): (154, 8),
+    (PERILS['storm surge'], coverages.COVERAGE_TYPES['contents']['id']): (154, 11),
+}
+
 class PiWindComplexModelKeysLookup(OasisBaseKeysLookup):
 
     def __init__(self,
@@ -36,65 +48,48 @@ class PiWindComplexModelKeysLookup(OasisBaseKeysLookup):
             coverages.COVERAGE_TYPES['contents']['id']
         ]
 
+        # One key row per (peril, coverage type), in output order, with its
+        # model_data serialised once
+        keys = []
+        for peril_id, coverage_type in itertools.product(self._peril_ids, self._coverage_types):
+            area_peril_id, vulnerability_id = KEY_DATA[(peril_id, coverage_type)]
+            keys.append({
+                'peril_id': peril_id,
+                'coverage_type': coverage_type,
+                'areaperil_id': area_peril_id,
+                'vulnerability_id': vulnerability_id,
+                'model_data': json.dumps({
+                    "area_peril_id": area_peril_id,
+                    "vulnerability_id": vulnerability_id
+                }),
+                'status': OASIS_KEYS_SC,
+                'message': "OK"
+            })
+        self._keys_df = pd.DataFrame(keys)
+
 
     def process_location(self, loc, peril_id, coverage_type):
 
-        status = OASIS_KEYS_SC
-        message = "OK"
-
-        if (
-            peril_id == PERILS['tropical cyclone'] and
-            coverage_type == coverages.COVERAGE_TYPES['buildings']['id']
-        ):
-            data = {
-                "area_peril_id": 54,
-                "vulnerability_id": 2
-            }
-
-        elif (
-            peril_id == PERILS['tropical cyclone'] and
-            coverage_type == coverages.COVERAGE_TYPES['contents']['id']
-        ):
-            data = {
-                "area_peril_id": 54,
-                "vulnerability_id": 5
-            }
-
-        elif (
-            peril_id == PERILS['storm surge'] and
-            coverage_type == coverages.COVERAGE_TYPES['buildings']['id']
-        ):
-            data = {
-                "area_peril_id": 154,
-                "vulnerability_id": 8
-            }
-
-        elif (
-            peril_id == PERILS['storm surge'] and
-            coverage_type == coverages.COVERAGE_TYPES['contents']['id']
-            ):
-            data = {
-                "area_peril_id": 154,
-                "vulnerability_id": 11
-            }
+        key = self._keys_df[
+            (self._keys_df['peril_id'] == peril_id) &
+            (self._keys_df['coverage_type'] == coverage_type)
+        ].iloc[0]
 
         return {
             'loc_id': loc['loc_id'],
             'locnumber': loc['locnumber'],
-            'peril_id': peril_id,
-            'coverage_type': coverage_type,
-            'areaperil_id': 154,
-            'vulnerability_id': 11,
-            'model_data': json.dumps(data),
-            'status': status,
-            'message': message
+            **key.to_dict()
         }
 
     def process_locations(self, loc_df):
+        """
+        Keys for every location, peril and coverage type, as one DataFrame.
+
+        Locations are cross-joined with the (peril, coverage type) key table,
+        giving the rows in the same order as process_location() over
+        product(locations, perils, coverage types).
+        """
 
         loc_df = loc_df.rename(columns=str.lower)
 
-        locs_seq = (loc for _, loc in loc_df.iterrows())
-        for loc, peril_id, coverage_type in \
-                itertools.product(locs_seq, self._peril_ids, self._coverage_types):
-            yield self.process_location(loc, peril_id, coverage_type)
+        return loc_df[['loc_id', 'locnumber']].merge(self._keys_df, how='cross')
@@ -0,0 +1,29 @@
+"""
+Build the precomputed footprint intensity table used by the complex model GUL
+wrapper.
+
+Reads footprint.bin/.idx (or footprint.bin.z/.idx.z) from a model data
+directory and writes footprint_intensity.bin/.idx alongside it. The table only
+depends on the footprint, so it needs rebuilding whenever the footprint changes.
+"""
+import argparse
+import logging
+import sys
+
+from .OasisLMF_ComplexModelExample_gulcalc import write_intensity_table
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build footprint_intensity.bin/.idx from a footprint.')
+    parser.add_argument('model_data_dir', help='Directory containing the footprint files')
+    args = parser.parse_args()
+
+    n_events = write_intensity_table(args.model_data_dir)
+    log.info(f'Wrote intensity table for {n_events} events to {args.model_data_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Event batching shared by the complex model wrappers.
+
+A custom gulcalc is run once per event batch (``-e n m``), and every batch
+must agree on which events it owns. The PiWindComplexModel and
+ComplexModelAPI wrappers both split events.bin with the functions below;
+the module is kept identical in each model package so the partitioning
+cannot drift between them (tests/test_event_batches.py checks this).
+"""
+import numpy as np
+import os
+
+EVENTS_DTYPE = np.dtype([('event_id', '<i4')])
+
+
+def read_event_ids(inputs_dir, events_filename='events.bin'):
+    """Read the event IDs from a ktools events.bin file."""
+    return np.fromfile(os.path.join(inputs_dir, events_filename), dtype=EVENTS_DTYPE)['event_id']
+
+
+def shuffle_events(event_ids):
+    """
+    Shuffle all events with a fixed seed so every batch sees the same order,
+    matching the behaviour of the original implementation for reproducibility.
+    """
+    np.random.seed(1234)
+    return np.random.choice(event_ids, len(event_ids), replace=False)
+
+
+def event_batch_slice(n_events, event_batch, max_event_batch):
+    """Slice of the shuffled events handled by batch n of m."""
+    chunk = int(np.ceil(n_events / max_event_batch))
+    return slice((event_batch - 1) * chunk, min(event_batch * chunk, n_events))
+
+
+def batch_event_ids(event_ids, event_batch, max_event_batch):
+    """Event IDs handled by batch n of m, in shuffled order."""
+    shuffled = shuffle_events(event_ids)
+    return shuffled[event_batch_slice(len(shuffled), event_batch, max_event_batch)]
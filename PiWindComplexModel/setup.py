@@ -6,7 +6,8 @@ setup(
     version='1.0.0.0',
     entry_points={
         'console_scripts': [
-            'OasisLMF_ComplexModelExample_gulcalc=complex_model_wrapper.OasisLMF_ComplexModelExample_gulcalc:main'
+            'OasisLMF_ComplexModelExample_gulcalc=complex_model_wrapper.OasisLMF_ComplexModelExample_gulcalc:main',
+            'OasisLMF_ComplexModelExample_build_intensity_table=complex_model_wrapper.build_intensity_table:main',
         ]
     }
 )
@@ -7,11 +7,17 @@ For example setting up a complex model wrapper.
 from oasislmf.execution.runner import run as oasislmf_run
 from oasislmf.execution.runner import run_analysis as oasislmf_run_analysis_chunk
 
+from complex_model_wrapper.OasisLMF_ComplexModelExample_gulcalc import prepare_shared_cache
+
 
 def run(analysis_settings,
         custom_gulcalc_cmd='OasisLMF_ComplexModelExample_gulcalc',
         **kwargs
         ):
+    # Runs from the model run directory: build the item/event cache shared by
+    # all gulcalc batches once, before ktools starts them in parallel.
+    prepare_shared_cache('input')
+
     oasislmf_run(analysis_settings,
         custom_gulcalc_cmd='OasisLMF_ComplexModelExample_gulcalc',
         **kwargs
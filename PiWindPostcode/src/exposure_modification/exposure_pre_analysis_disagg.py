@@ -1,24 +1,166 @@
+import argparse
+import logging
+import numpy as np
 import os
 import pandas as pd
 
-counter_dict = {}
+# Built environment TIV and NumberOfBuildings fields that are disaggregated by OccupancyCode weight
+WEIGHT_FIELDS = ['BuildingTIV', 'ContentsTIV', 'BITIV', 'NumberOfBuildings']
 
-# Function to make LocNumbers unique when disaggregated to multiple rows
+# Rows per Parquet row group of the compiled weights, small enough that a filter on PostalCode skips most of the file
+WEIGHTS_ROW_GROUP_SIZE = 1 << 16
 
+# Peak memory while disaggregating a chunk (merge, new columns, drop and rename), as a multiple of the chunk's output size
+CHUNK_MEMORY_FACTOR = 3
 
-def update_loc_number(row):
 
-    global counter_dict
-    loc_number_value = row['LocNumber']
+def postcode_keys(postcodes):
+    """
+    PostalCodes as strings, for matching locations to the built environment whichever way either side was parsed:
+    numeric postcodes become their digits, without the '.0' of a float column.
+    """
+    postcodes = pd.Series(postcodes)
+    if pd.api.types.is_float_dtype(postcodes) and (postcodes.dropna() % 1 == 0).all():
+        postcodes = postcodes.astype('Int64')
+    return postcodes.astype(str)
+
+
+def unique_loc_numbers(loc_numbers, seen=None):
+    """
+    Make LocNumbers unique when disaggregated to multiple rows: each row becomes
+    'LocNumber_counter', counting from 1 within each LocNumber in row order.
+
+    seen is a dict of the number of rows already numbered for each LocNumber,
+    by earlier chunks of the same locations, so that their counters carry on.
+    It is updated with the rows numbered here.
+    """
+    loc_numbers = loc_numbers.astype(str)
+    counter = loc_numbers.groupby(loc_numbers, sort=False).cumcount() + 1
+    if seen is not None:
+        counter += loc_numbers.map(seen).fillna(0).astype('int64')
+        counts = loc_numbers.value_counts()
+        counts += counts.index.map(seen).fillna(0).astype('int64')
+        seen.update(zip(counts.index, counts.to_numpy().tolist()))
+    return loc_numbers + '_' + counter.astype(str)
+
+
+def chunk_bounds(output_rows, row_bytes, memory_limit=None):
+    """
+    Split the locations to disaggregate into contiguous chunks, each expected to need at most memory_limit bytes,
+    given the number of output rows of each location and the size of an output row. Returns the chunk boundaries,
+    one chunk (which may be empty) if there is no limit. A location over the limit on its own gets a chunk to itself.
+    """
+    if not memory_limit:
+        return [0, len(output_rows)]
+
+    cum_bytes = np.cumsum(np.asarray(output_rows, dtype='float64') * row_bytes * CHUNK_MEMORY_FACTOR)
+    bounds = [0]
+    while bounds[-1] < len(cum_bytes):
+        start = bounds[-1]
+        start_bytes = cum_bytes[start - 1] if start else 0
+        end = int(np.searchsorted(cum_bytes, start_bytes + memory_limit, side='right'))
+        bounds.append(max(end, start + 1))
+    return bounds
+
+
+def allocate_buildings(number_of_buildings, weights, source_rows):
+    """
+    Split each source location's NumberOfBuildings across its disaggregated rows in proportion to the weights, in
+    whole buildings that add up exactly to the original (largest remainder method): each row gets the whole part of
+    its share, and the buildings left over go one each to the rows with the largest fractional parts, ties to the
+    earlier row.
+
+    All arguments are per disaggregated row; source_rows numbers the source locations 0..n-1 and gives the
+    NumberOfBuildings of its source location. Returns the allocated NumberOfBuildings as floats.
+    """
+    number_of_buildings = np.asarray(number_of_buildings, dtype='float64')
+    source_rows = np.asarray(source_rows, dtype='int64')
+    n_sources = source_rows.max() + 1 if len(source_rows) else 0
+
+    share = number_of_buildings * np.asarray(weights, dtype='float64')
+    allocated = np.floor(share)
+    remainder = share - allocated
+
+    # buildings left to allocate for each source location
+    total = np.zeros(n_sources)
+    total[source_rows] = np.rint(number_of_buildings)
+    left_over = np.maximum(total - np.bincount(source_rows, weights=allocated, minlength=n_sources), 0)
+
+    # rank the rows of each source location by descending remainder, and add one building to the first left_over.
+    # The sort key keeps each source location in [source_row, source_row + 0.5], so a single stable sort orders by
+    # location then remainder, and is fast on rows that are already grouped by location, as they are after the merge.
+    order = np.argsort(source_rows + (1 - remainder) / 2, kind='stable')
+    sorted_sources = source_rows[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_sources, sorted_sources)
+    allocated[order] += rank < left_over[sorted_sources]
+    return allocated
+
+
+def disaggregate_locations(df_source_loc_disagg, df_weights):
+    """
+    Split each location into one row per OccupancyCode of its PostalCode, allocating TIV and NumberOfBuildings by the
+    occupancy weights, see allocate_buildings(). The original values are kept in FlexiLoc fields, as we don't want to use them for the
+    disaggregated locations. LocNumbers are left to the caller to make unique.
+    """
+    # Disaggregate the TIV and Number of Buildings using the weights
+    df_source_disagg = pd.merge(
+        df_source_loc_disagg.assign(source_row=np.arange(len(df_source_loc_disagg)), postcode_key=postcode_keys(df_source_loc_disagg['PostalCode'])),
+        df_weights.rename(columns={'PostalCode': 'postcode_key'}), on='postcode_key')
+    df_source_disagg['BuildingTIV_new'] = df_source_disagg['BuildingTIV'] * df_source_disagg['BuildingTIV_weight']
+    df_source_disagg['ContentsTIV_new'] = df_source_disagg['ContentsTIV'] * df_source_disagg['ContentsTIV_weight']
+    df_source_disagg['BITIV_new'] = df_source_disagg['BITIV'] * df_source_disagg['BITIV_weight']
+    df_source_disagg['NumberOfBuildings_new'] = allocate_buildings(
+        df_source_disagg['NumberOfBuildings'], df_source_disagg['NumberOfBuildings_weight'], df_source_disagg['source_row'])
+    df_source_disagg['NumberOfBuildings_new'] = df_source_disagg['NumberOfBuildings_new'].astype(int)
+
+    # Tidy up and set the original OED field values to use the calculated values.
+    df_source_disagg = df_source_disagg.drop(columns=['source_row', 'postcode_key', 'BuildingTIV_weight', 'ContentsTIV_weight', 'BITIV_weight', 'NumberOfBuildings_weight'])
+    df_source_disagg.rename(columns={'OccupancyCode': 'FlexiLocOccupancyCodeOrig', 'BuildingTIV': 'FlexiLocBuildingTIVOrig',
+                            'ContentsTIV': 'FlexiLocContentsTIVOrig', 'BITIV': 'FlexiLocBITIVOrig', 'NumberOfBuildings': 'FlexiLocNumberOfBuildingsOrig'}, inplace=True)
+    df_source_disagg.rename(columns={'OccupancyCode_new': 'OccupancyCode', 'BuildingTIV_new': 'BuildingTIV',
+                            'ContentsTIV_new': 'ContentsTIV', 'BITIV_new': 'BITIV', 'NumberOfBuildings_new': 'NumberOfBuildings'}, inplace=True)
+    return df_source_disagg
+
+
+def occupancy_weights(df_built_env):
+    """
+    Weights for TIV and NumberOfBuildings disaggregation by OccupancyCode within PostalCode, from the built environment
+    OED locations: one row per (PostalCode, OccupancyCode_new), sorted by both, with a '<field>_weight' column per
+    WEIGHT_FIELDS. PostalCodes are returned as postcode_keys().
+    """
+    df_built_env = df_built_env.assign(PostalCode=postcode_keys(df_built_env['PostalCode']))
+    sum_pc_occ = df_built_env.groupby(['PostalCode', 'OccupancyCode'], as_index=False)[WEIGHT_FIELDS].sum()
+    sum_pc = sum_pc_occ.groupby('PostalCode')[WEIGHT_FIELDS].transform('sum')
+
+    weights = sum_pc_occ[['PostalCode', 'OccupancyCode']].rename(columns={'OccupancyCode': 'OccupancyCode_new'})
+    for field in WEIGHT_FIELDS:
+        weights[f'{field}_weight'] = sum_pc_occ[field] / sum_pc[field]
+    return weights
 
-    if loc_number_value not in counter_dict:
-        counter_dict[loc_number_value] = 1
-    else:
-        counter_dict[loc_number_value] += 1
 
-    row['LocNumber'] = f'{loc_number_value}_{counter_dict[loc_number_value]}'
+def compile_built_environment(csv_path, weights_path):
+    """
+    One-time step: read the built environment CSV and write its occupancy weights to a Parquet file, sorted by
+    PostalCode so that load_occupancy_weights() only reads the row groups it needs.
+    """
+    weights = occupancy_weights(pd.read_csv(csv_path))
+    weights.to_parquet(weights_path, index=False, row_group_size=WEIGHTS_ROW_GROUP_SIZE)
+    return weights
+
 
-    return row
+def load_occupancy_weights(path, postcodes):
+    """
+    Occupancy weights for the given postcodes only. path is either a Parquet file written by
+    compile_built_environment(), which is memory-mapped and filtered on PostalCode, or the built environment CSV,
+    whose weights are computed here.
+    """
+    postcodes = sorted(set(postcode_keys(postcodes)))
+    if not path.endswith('.parquet'):
+        df_built_env = pd.read_csv(path)
+        return occupancy_weights(df_built_env[postcode_keys(df_built_env['PostalCode']).isin(postcodes)])
+    if not postcodes:
+        return pd.read_parquet(path, memory_map=True).iloc[:0]
+    return pd.read_parquet(path, filters=[('PostalCode', 'in', postcodes)], memory_map=True)
 
 
 class ExposurePreAnalysis:
@@ -32,6 +174,18 @@ class ExposurePreAnalysis:
     This represents a partial disaggregation of aggregate locations to the attributes that are important in the model (just OccupancyCode for PiWind) and then
     the partially disaggregated risks can be split equally into individual buildings during the model execution.
 
+    The 'Built_environment' setting is either the reference CSV itself, or a Parquet file of its precomputed occupancy
+    weights, written once with
+
+        python exposure_pre_analysis_disagg.py OEDLocBuiltEnv.csv OEDLocBuiltEnv.parquet
+
+    in which case only the weights of the portfolio's postcodes are read on each run.
+
+    For very large portfolios, the optional 'Memory_limit_MB' setting streams the disaggregation: the locations to
+    disaggregate are processed in chunks sized so that each chunk's intermediate frames stay within the limit, and only
+    the finished rows of each chunk are kept. The output is assembled from them one field at a time, so peak memory is
+    about the input and output location data plus the limit. The output is the same as without a limit.
+
     This routine enables the model provider to augment the source location data with information that is important for the model (to make the best choice of
     vulnerability functions) using known built environment data in OED location format, without performing a full disaggregation to individual building level 
     pre-analysis. 
@@ -45,12 +199,11 @@ class ExposurePreAnalysis:
 
         location_df = self.exposure_data.location.dataframe
 
-        # access custom CSV file defined in exposure_pre_analysis_settings file
-        csv_path = self.exposure_pre_analysis_setting['Built_environment']
-        if not os.path.isabs(csv_path):
+        # access built environment file defined in exposure_pre_analysis_settings file
+        built_env_path = self.exposure_pre_analysis_setting['Built_environment']
+        if not os.path.isabs(built_env_path):
             module_dir = os.path.dirname(os.path.abspath(__file__))
-            csv_path = os.path.normpath(os.path.join(module_dir, csv_path))
-        df_built_env = pd.read_csv(csv_path)
+            built_env_path = os.path.normpath(os.path.join(module_dir, built_env_path))
 
         # Fill source location file defaults for disaggregation
 
@@ -78,67 +231,70 @@ class ExposurePreAnalysis:
 
         bool_disagg = ((location_df['OccupancyCode'] == 1000) & (location_df['NumberOfBuildings'] > 1) & (location_df['PostalCode'].notna()))
 
+        # Weights for TIV and Number of Buildings disaggregation by OccupancyCode within PostalCode, for the PostalCodes to disaggregate
+        postcodes = postcode_keys(location_df.loc[bool_disagg, 'PostalCode'])
+        df_weights = load_occupancy_weights(built_env_path, postcodes.unique())
+
+        # Locations whose PostalCode is not in the built environment can't be disaggregated, keep them as they are
+        no_weights = ~postcodes.isin(df_weights['PostalCode'])
+        if no_weights.any():
+            missing = postcodes[no_weights].unique()
+            logging.warning(f"{no_weights.sum()} locations to disaggregate have a PostalCode with no built environment data and are "
+                            f"left as they are, PostalCodes: {', '.join(missing[:20])}{' ...' if len(missing) > 20 else ''}")
+            bool_disagg = bool_disagg & ~location_df.index.isin(postcodes.index[no_weights])
+
         # Filter locations that need disaggregation
         df_source_loc_disagg = location_df[bool_disagg]
 
-        # Filter locations that don't need disaggregation
-        df_source_loc_no_disagg = location_df[~bool_disagg]
-
-        # merge locations that need disaggregation with built environment file on PostalCode
-        df_merge_groupsum_pc_occ_1 = pd.merge(df_source_loc_disagg, df_built_env, on='PostalCode').groupby(['PostalCode', 'OccupancyCode_y'], as_index=False).agg({
-            'BuildingTIV_y': 'sum', 'ContentsTIV_y': 'sum', 'OtherTIV_y': 'sum', 'BITIV_y': 'sum', 'NumberOfBuildings_y': 'sum'})
-        df_merge_groupsum_pc_occ_1.rename(columns={'OccupancyCode_y': 'OccupancyCode_new', 'BuildingTIV_y': 'BuildingTIV_Occ', 'ContentsTIV_y': 'ContentsTIV_Occ',
-                                          'OtherTIV_y': 'OtherTIV_Occ', 'BITIV_y': 'BITIV_Occ', 'NumberOfBuildings_y': 'NumberOfBuildings_Occ'}, inplace=True)
-
-        # group merged locations by PostalCode and sum values across OccupancyCode
-        df_groupsum_pc_2 = df_merge_groupsum_pc_occ_1.groupby(['PostalCode']).agg(
-            {'BuildingTIV_Occ': 'sum', 'ContentsTIV_Occ': 'sum', 'OtherTIV_Occ': 'sum', 'BITIV_Occ': 'sum', 'NumberOfBuildings_Occ': 'sum'})
-        df_groupsum_pc_2.rename(columns={'BuildingTIV_Occ': 'BuildingTIV_Tot', 'ContentsTIV_Occ': 'ContentsTIV_Tot',
-                                'OtherTIV_Occ': 'OtherTIV_Tot', 'BITIV_Occ': 'BITIV_Tot', 'NumberOfBuildings_Occ': 'NumberOfBuildings_Tot'}, inplace=True)
-
-        # Merge df 1 and df 2 back together so that weights can be calculated by OccupancyCode and PostalCode
-        df_merge_3 = pd.merge(df_merge_groupsum_pc_occ_1, df_groupsum_pc_2, on='PostalCode', how="outer")
-
-        # Calculate the weights for TIV and Number of Buildings disaggregation by OccupancyCode within PostalCode
-        df_merge_3['BuildingTIV_weight'] = df_merge_3['BuildingTIV_Occ'] / df_merge_3['BuildingTIV_Tot']
-        df_merge_3['ContentsTIV_weight'] = df_merge_3['ContentsTIV_Occ'] / df_merge_3['ContentsTIV_Tot']
-        df_merge_3['BITIV_weight'] = df_merge_3['BITIV_Occ'] / df_merge_3['BITIV_Tot']
-        df_merge_3['NumberOfBuildings_weight'] = df_merge_3['NumberOfBuildings_Occ'] / df_merge_3['NumberOfBuildings_Tot']
-
-        # Disaggregate the TIV and Number of Buildings using the weights
-        df_source_disagg = pd.merge(df_source_loc_disagg, df_merge_3, on='PostalCode')
-        df_source_disagg['BuildingTIV_new'] = df_source_disagg['BuildingTIV'] * df_source_disagg['BuildingTIV_weight']
-        df_source_disagg['ContentsTIV_new'] = df_source_disagg['ContentsTIV'] * df_source_disagg['ContentsTIV_weight']
-        df_source_disagg['BITIV_new'] = df_source_disagg['BITIV'] * df_source_disagg['BITIV_weight']
-        df_source_disagg['NumberOfBuildings_new'] = df_source_disagg['NumberOfBuildings'] * df_source_disagg['NumberOfBuildings_weight']
-        df_source_disagg['NumberOfBuildings_new'] = df_source_disagg['NumberOfBuildings_new'].round(
-            decimals=0).astype(int)  # ! Need to make sure sum adds up to original NumberOfBuildings
-
-        # Reindex LocNumbers to be unique 'LocNumber_counter'
-        df_source_disagg = df_source_disagg.apply(update_loc_number, axis=1)
-
-        # Tidy up and set the original OED field values to use the calculated values. Use FlexiLoc fields for the original values which we don't want to use for disaggregated locations.
-        df_source_disagg = df_source_disagg.drop(columns=['BuildingTIV_Occ', 'ContentsTIV_Occ', 'OtherTIV_Occ', 'BITIV_Occ', 'NumberOfBuildings_Occ',
-                                                          'BuildingTIV_Tot', 'ContentsTIV_Tot', 'OtherTIV_Tot', 'BITIV_Tot', 'NumberOfBuildings_Tot', 'BuildingTIV_weight', 'ContentsTIV_weight',
-                                                          'BITIV_weight', 'NumberOfBuildings_weight', ])
-        df_source_disagg.rename(columns={'OccupancyCode': 'FlexiLocOccupancyCodeOrig', 'BuildingTIV': 'FlexiLocBuildingTIVOrig',
-                                'ContentsTIV': 'FlexiLocContentsTIVOrig', 'BITIV': 'FlexiLocBITIVOrig', 'NumberOfBuildings': 'FlexiLocNumberOfBuildingsOrig'}, inplace=True)
-        df_source_disagg.rename(columns={'OccupancyCode_new': 'OccupancyCode', 'BuildingTIV_new': 'BuildingTIV',
-                                'ContentsTIV_new': 'ContentsTIV', 'BITIV_new': 'BITIV', 'NumberOfBuildings_new': 'NumberOfBuildings'}, inplace=True)
+        # Filter locations that don't need disaggregation. take() gives a new frame rather than a view of location_df,
+        # so its fields can be renamed and added to below without copying it again.
+        df_source_loc_no_disagg = location_df.take(np.flatnonzero(~bool_disagg))
+
+        # Disaggregate in chunks of locations within the memory limit, if any. Each chunk is joined to the weights of its
+        # own PostalCodes, so only the LocNumber counters need carrying over from one chunk to the next.
+        memory_limit = self.exposure_pre_analysis_setting.get('Memory_limit_MB')
+        output_rows = postcode_keys(df_source_loc_disagg['PostalCode']).map(df_weights['PostalCode'].value_counts()).fillna(0).to_numpy()
+        row_bytes = location_df.memory_usage(deep=True).sum() / max(len(location_df), 1)
+        bounds = chunk_bounds(output_rows, row_bytes, memory_limit and memory_limit * (1 << 20))
+
+        disagg_chunks = []
+        seen = {}
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            df_chunk = disaggregate_locations(df_source_loc_disagg.iloc[start:end], df_weights)
+
+            # Reindex LocNumbers to be unique 'LocNumber_counter'
+            df_chunk['LocNumber'] = unique_loc_numbers(df_chunk['LocNumber'], seen)
+            disagg_chunks.append(df_chunk)
+        del df_source_loc_disagg
 
         # Align the locations that haven't been disaggregated to the new OED location output file. We keep the original TIVs and NumberOfBuildings unchanged for these.
-        # Have to make a copy here, to avoid python warnings about inplace replacement / renaming of fields for a slice of a dataframe.
-        df_copy = df_source_loc_no_disagg.copy()
-        df_copy.rename(columns={'OccupancyCode': 'FlexiLocOccupancyCodeOrig', 'BuildingTIV': 'FlexiLocBuildingTIVOrig',
-                       'ContentsTIV': 'FlexiLocContentsTIVOrig', 'BITIV': 'FlexiLocBITIVOrig', 'NumberOfBuildings': 'FlexiLocNumberOfBuildingsOrig'}, inplace=True)
-        df_copy['OccupancyCode'] = df_copy['FlexiLocOccupancyCodeOrig']
-        df_copy['BuildingTIV'] = df_copy['FlexiLocBuildingTIVOrig']
-        df_copy['ContentsTIV'] = df_copy['FlexiLocContentsTIVOrig']
-        df_copy['BITIV'] = df_copy['FlexiLocBITIVOrig']
-        df_copy['NumberOfBuildings'] = df_copy['FlexiLocNumberOfBuildingsOrig']
-
-        # Vertical merge the disaggregated locations with the locations that did not need disaggregation
-        df_output = pd.concat([df_copy, df_source_disagg], axis=0, ignore_index=True, join='inner')
+        df_no_disagg = df_source_loc_no_disagg
+        del df_source_loc_no_disagg
+        df_no_disagg.rename(columns={'OccupancyCode': 'FlexiLocOccupancyCodeOrig', 'BuildingTIV': 'FlexiLocBuildingTIVOrig',
+                            'ContentsTIV': 'FlexiLocContentsTIVOrig', 'BITIV': 'FlexiLocBITIVOrig', 'NumberOfBuildings': 'FlexiLocNumberOfBuildingsOrig'}, inplace=True)
+        df_no_disagg['OccupancyCode'] = df_no_disagg['FlexiLocOccupancyCodeOrig']
+        df_no_disagg['BuildingTIV'] = df_no_disagg['FlexiLocBuildingTIVOrig']
+        df_no_disagg['ContentsTIV'] = df_no_disagg['FlexiLocContentsTIVOrig']
+        df_no_disagg['BITIV'] = df_no_disagg['FlexiLocBITIVOrig']
+        df_no_disagg['NumberOfBuildings'] = df_no_disagg['FlexiLocNumberOfBuildingsOrig']
+
+        # Vertical merge the disaggregated locations with the locations that did not need disaggregation (the fields
+        # they have in common), one field at a time. Each field is dropped from the pieces once merged, so the pieces
+        # and the output are not both held in full.
+        pieces = [df_no_disagg] + disagg_chunks
+        del df_no_disagg, disagg_chunks
+        fields = [field for field in pieces[0].columns if all(field in piece.columns for piece in pieces[1:])]
+        df_output = pd.DataFrame({field: pd.concat([piece.pop(field) for piece in pieces], ignore_index=True)
+                                  for field in fields}, copy=False)
+        del pieces
 
         # df_output to be written out to location.csv
         self.exposure_data.location.dataframe = df_output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the built environment CSV into a Parquet file of occupancy weights by PostalCode')
+    parser.add_argument('built_environment_csv', help='OED location file of the built environment')
+    parser.add_argument('weights_parquet', help='Parquet file to write, for the Built_environment setting')
+    args = parser.parse_args()
+    compile_built_environment(args.built_environment_csv, args.weights_parquet)
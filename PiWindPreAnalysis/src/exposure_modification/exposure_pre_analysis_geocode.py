@@ -1,28 +1,215 @@
 import base64
 import requests
 import logging
+import os
+import sqlite3
+import threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def normalise_addresses(addresses):
+    """
+    Cache keys for a frame of (address, postcode, country) columns: each part
+    stripped, upper-cased and with runs of whitespace collapsed, so trivially
+    different spellings share an entry. Missing parts are empty.
+    """
+    key = None
+    for column in addresses.columns:
+        values = addresses[column].astype(object)
+        part = values.where(values.notna(), '').astype(str).str.upper().str.split().str.join(' ')
+        key = part if key is None else key + '|' + part
+    return key
+
+
+class GeocodeCache:
+    """
+    Persistent geocode results in a SQLite file, so that repeated runs over
+    the same portfolio do not call the API again. Results are keyed on the
+    geocode endpoint as well as the normalised address, since each of
+    Precisely's service levels gives its own results. Only successful results
+    are stored.
+    """
+
+    def __init__(self, path, geocode_uri):
+        self.geocode_uri = geocode_uri
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS geocode_results ("
+            "geocode_uri TEXT, address_key TEXT, latitude REAL, longitude REAL, quality REAL, "
+            "PRIMARY KEY (geocode_uri, address_key))"
+        )
+
+    def get_many(self, keys):
+        """Cached (latitude, longitude, quality) for those of keys that are cached."""
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.connection.execute(
+                "SELECT address_key, latitude, longitude, quality FROM geocode_results "
+                f"WHERE geocode_uri = ? AND address_key IN ({','.join('?' * len(chunk))})",
+                [self.geocode_uri, *chunk]
+            )
+            for key, latitude, longitude, quality in rows:
+                found[key] = (latitude, longitude, quality)
+        return found
+
+    def put_many(self, results):
+        """Store a dict of key -> (latitude, longitude, quality)."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO geocode_results VALUES (?, ?, ?, ?, ?)",
+                [(self.geocode_uri, key, *result) for key, result in results.items()]
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class PreciselyGeocoder:
+    """
+    Client for Precisely's token and geocode endpoints.
+
+    One requests session is shared by all worker threads, with a connection
+    pool sized to the number of workers and retries with exponential backoff
+    on connection errors, 429 and 5xx responses. The access token is acquired
+    on first use and refreshed once, by whichever thread sees it first, when
+    the API rejects it with 401.
+    """
+
+    def __init__(self, token_uri, geocode_uri, api_key, api_secret_key,
+                 max_workers=8, max_retries=3, backoff_factor=0.5, timeout=30):
+        self.token_uri = token_uri
+        self.geocode_uri = geocode_uri
+        self.api_key = api_key
+        self.api_secret_key = api_secret_key
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET', 'POST'],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._token = None
+        self._token_lock = threading.Lock()
+
+    # gain access token for Precisely API
+    def acquire_auth_token(self):
+        auth_str = self.api_key + ":" + self.api_secret_key
+        base64_value = base64.b64encode(auth_str.encode("utf-8")).decode("utf-8")
+        headers = {
+            "Authorization": "Basic " + base64_value,
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        data = {
+            "grant_type": "client_credentials"
+        }
+        response = self.session.post(self.token_uri, headers=headers, data=data, timeout=self.timeout)
+        try:
+            access_token = response.json()["access_token"]
+            return access_token
+        except Exception:
+            logging.error(f"Failed to acquire access token. Status Code: {response.status_code}, Error Message: {response.text}")
+            return None
+
+    def _access_token(self, rejected=None):
+        """Current token; a new one if it is missing or is the rejected one."""
+        with self._token_lock:
+            if self._token is None or self._token == rejected:
+                self._token = self.acquire_auth_token()
+            return self._token
+
+    #  function to geocode with address, postcode, and country
+    def geocode_location(self, address, postcode, country):
+        """
+        Geocode one address. Returns (latitude, longitude, quality), or None
+        if the API has no result for it.
+        """
+        params = {
+            "mainAddress": address,
+            "postalCode": postcode,
+            "country": country,
+        }
+        access_token = self._access_token()
+        for attempt in range(2):
+            if access_token is None:
+                return None
+            headers = {
+                "Authorization": "Bearer " + access_token,
+                "Content-Type": "application/json"
+            }
+            response = self.session.get(self.geocode_uri, headers=headers, params=params, timeout=self.timeout)
+            if response.status_code == 401 and attempt == 0:
+                access_token = self._access_token(rejected=access_token)
+                continue
+            break
+
+        try:
+            candidate = response.json()["candidates"][0]
+        except Exception:
+            logging.error(f"Geocoding failed. Status Code: {response.status_code}, Error Message: {response.text}")
+            return None
+
+        # scale quality:
+        # Precisely's quality is graded on a scale from 0 to 20. However, the OED's GeocodeQuality is graded as a
+        # decimal between 0 and 1. Therefore, the quality needs to be divided by 20 to give a value between 0 and 1.
+        longitude, latitude = candidate["geometry"]["coordinates"][:2]
+        return latitude, longitude, candidate["precisionLevel"] / 20
+
+    def geocode_many(self, addresses):
+        """
+        Geocode a dict of key -> (address, postcode, country) with a pool of
+        worker threads. Returns a dict of key -> result, see geocode_location().
+        """
+        keys = list(addresses)
+
+        def geocode(key):
+            try:
+                return self.geocode_location(*addresses[key])
+            except requests.RequestException as e:
+                logging.error(f"Geocoding failed for {addresses[key]}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return dict(zip(keys, pool.map(geocode, keys)))
 
 
 class ExposurePreAnalysis:
     """
     Example of custom module called by oasislmf/model_preparation/ExposurePreAnalysis.py
 
-    This model amends OED location data that's missing Latitude and Longitude fields, which are needed for the model to 
-    yeild accurate results. It used Precisely's Geocode API to assign the incomplete location addresses lat-long values based on 
+    This model amends OED location data that's missing Latitude and Longitude fields, which are needed for the model to
+    yeild accurate results. It used Precisely's Geocode API to assign the incomplete location addresses lat-long values based on
     the location data available (street address, postal code, country code, etc.).
 
-    To use Precisely's API, the module first needs to gain access via an access token. This is achieved by passing your API key and 
+    To use Precisely's API, the module first needs to gain access via an access token. This is achieved by passing your API key and
     secret key with requests. To run the model, your keys need to be inserted in tests/test_x/exposure_pre_analysis_geocode.json.
-    More information of how to gain your keys can be found at 
+    More information of how to gain your keys can be found at
     https://docs.precisely.com/docs/sftw/precisely-apis/main/en-us/webhelp/apis/Getting%20Started/making_first_call.html.
 
-    The location data is then geocoded. The incomplete address data is extracted from the Loc file and passed to Precisely's 
-    Geocode API, along with the access token. The API returns a complete version of the addresses which included the lat-long pairs. 
+    The location data is then geocoded. The incomplete address data is extracted from the Loc file and passed to Precisely's
+    Geocode API, along with the access token. The API returns a complete version of the addresses which included the lat-long pairs.
     These are inserted into the Loc file to complete it, along with new Geocode OED fields (if not already present).
 
-    Precicely offer three levels of service that correspond to the precision of their Geocode API. This can be changed by altering 
-    the "Geocode_URI" key in exposure_pre_analysis_geocode.json. More information on their levels of service can be found at 
+    Each distinct (address, postcode, country) is geocoded once, by a pool of concurrent requests. If the "Cache_Path"
+    setting gives a SQLite file, results are kept there, per Geocode_URI, so later runs only call the API for new
+    addresses; there is no cache by default. "Max_Workers", "Max_Retries", "Backoff_Factor"
+    and "Timeout" tune the client. "Token_URI" and "Geocode_URI" can point at any compatible endpoint, such as a local
+    stand-in server for testing.
+
+    Precicely offer three levels of service that correspond to the precision of their Geocode API. This can be changed by altering
+    the "Geocode_URI" key in exposure_pre_analysis_geocode.json. More information on their levels of service can be found at
     https://docs.precisely.com/docs/sftw/precisely-apis/main/en-us/webhelp/apis/Geocode/Geocode/LI_Geo_GET_url.html
     """
 
@@ -33,99 +220,72 @@ class ExposurePreAnalysis:
     def run(self):
         # load exposure object into dataframe
         location_df = self.exposure_data.location.dataframe
+        settings = self.exposure_pre_analysis_setting
 
         # get API details
-        token_uri = self.exposure_pre_analysis_setting['Token_URI']
-        geocode_uri = self.exposure_pre_analysis_setting['Geocode_URI']
-        api_key = self.exposure_pre_analysis_setting['API_Key']
-        api_secret_key = self.exposure_pre_analysis_setting['API_Secret_Key']
-
+        geocoder = PreciselyGeocoder(
+            token_uri=settings['Token_URI'],
+            geocode_uri=settings['Geocode_URI'],
+            api_key=settings['API_Key'],
+            api_secret_key=settings['API_Secret_Key'],
+            max_workers=settings.get('Max_Workers', 8),
+            max_retries=settings.get('Max_Retries', 3),
+            backoff_factor=settings.get('Backoff_Factor', 0.5),
+            timeout=settings.get('Timeout', 30),
+        )
+        cache_path = settings.get('Cache_Path')
 
-        # call API
-
-        # gain access token for Precisely API
-        def acquire_auth_token():
-            auth_str = api_key + ":" + api_secret_key
-            base64_value = base64.b64encode(auth_str.encode("utf-8")).decode("utf-8")
-            headers = {
-                "Authorization": "Basic " + base64_value,
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-            data = {
-                "grant_type": "client_credentials"
-            }
-            response = requests.post(token_uri, headers=headers, data=data)
-            try:
-                access_token = response.json()["access_token"]
-                return access_token
-            except:
-                logging.error(f"Failed to acquire access token. Status Code: {response.status_code}, Error Message: {response.json()}")
-                return None
+        # distinct addresses of the rows missing a lat or lon
+        missing_coords = (location_df['Latitude'].isnull() | location_df['Longitude'].isnull()).to_numpy()
+        to_geocode = location_df.loc[missing_coords, ['StreetAddress', 'PostalCode', 'CountryCode']]
+        keys = normalise_addresses(to_geocode)
+        first = ~keys.duplicated().to_numpy()
+        addresses = dict(zip(keys[first], to_geocode[first].itertuples(index=False, name=None)))
 
-        #  function to geocode with address, postcode, and country
-        def geocode_location(access_token, address, postcode, country):
-            headers = {
-                "Authorization": "Bearer " + access_token,
-                "Content-Type": "application/json"
-            }
-            params = {
-                "mainAddress": address,
-                "postalCode": postcode,
-                "country": country,
-            }
-            response = requests.get(geocode_uri, headers=headers, params=params)
-            try:
-                geocode_result = response.json()
-                return geocode_result
-            except:
-                logging.error(f"Geocoding failed. Status Code: {response.status_code}, Error Message: {response.json()}")
-                return None
-                
-        
-        
+        # call API for the addresses not already cached
+        cache = GeocodeCache(os.path.abspath(cache_path), settings['Geocode_URI']) if cache_path else None
+        try:
+            results = cache.get_many(addresses) if cache else {}
+            missing = {key: address for key, address in addresses.items() if key not in results}
+            logging.info(f"Geocoding {len(missing)} of {len(addresses)} distinct addresses "
+                         f"({len(addresses) - len(missing)} cached)")
+            fetched = geocoder.geocode_many(missing)
+            fetched = {key: result for key, result in fetched.items() if result is not None}
+            if cache:
+                cache.put_many(fetched)
+            results.update(fetched)
+        finally:
+            if cache:
+                cache.close()
 
-        # update lat/longs where missing
+        # update lat/longs where missing, one assignment per column
 
-        access_token = acquire_auth_token()
-        
         # check if Geocoder fields are in the dataframe - if not, they are added
         if 'Geocoder' not in location_df.columns:
             location_df['Geocoder'] = None
         if 'GeocodeQuality' not in location_df.columns:
             location_df['GeocodeQuality'] = None
+        if isinstance(location_df['Geocoder'].dtype, pd.CategoricalDtype) and \
+                'Precisely' not in location_df['Geocoder'].cat.categories:
+            location_df['Geocoder'] = location_df['Geocoder'].cat.add_categories(['Precisely'])
 
-        for idx, row in location_df.iterrows():
-            COUNTRYCODE = row['CountryCode']
-            ADDRESS = row['StreetAddress']
-            POSTALCODE = row['PostalCode']
-
-            # check if lat or lon value in current row is empty 
-            if pd.isnull(row['Latitude']) or pd.isnull(row['Longitude']):
-
-                # geocode row for lat and lon
-                geocode_result = geocode_location(access_token, ADDRESS, POSTALCODE, COUNTRYCODE)
-                if geocode_result:
-                    # assign lat and lon, and GeocodePrecision from geocode results
-                    latitude = geocode_result["candidates"][0]["geometry"]["coordinates"][1]
-                    longitude = geocode_result["candidates"][0]["geometry"]["coordinates"][0]
-                    quality = geocode_result["candidates"][0]["precisionLevel"]
-                    # scale quality: 
-                    # Precisely's quality is graded on a scale from 0 to 20. However, the OED's GeocodeQuality is graded as a 
-                    # decimal between 0 and 1. Therefore, the quality needs to be divided by 20 to give a value between 0 and 1.
-                    quality = quality/20
-
-                    # insert lat and lon into row with 7dp
-                    location_df.at[idx, 'Latitude'] = '{:.7f}'.format(latitude)
-                    location_df.at[idx, 'Longitude'] = '{:.7f}'.format(longitude)
-                    # add geocode OED field values
-                    location_df.at[idx, 'Geocoder'] = "Precisely"
-                    location_df.at[idx, 'GeocodeQuality'] = quality
-                    
-                else:
-                    logging.error(f"Geocoding failed. Not enough data in Location file on line {idx}")
-            else:
-                pass
+        geocoded = pd.DataFrame.from_dict(
+            results, orient='index', columns=['Latitude', 'Longitude', 'GeocodeQuality'], dtype='float64'
+        ).reindex(keys.to_numpy())
+        found = geocoded['Latitude'].notna().to_numpy()
+        rows = to_geocode.index[found]
+        geocoded = geocoded[found]
+
+        # insert lat and lon rounded to 7dp
+        location_df.loc[rows, 'Latitude'] = geocoded['Latitude'].round(7).to_numpy()
+        location_df.loc[rows, 'Longitude'] = geocoded['Longitude'].round(7).to_numpy()
+        # add geocode OED field values
+        location_df.loc[rows, 'Geocoder'] = "Precisely"
+        location_df.loc[rows, 'GeocodeQuality'] = geocoded['GeocodeQuality'].to_numpy()
+
+        if not found.all():
+            failed = to_geocode.index[~found]
+            logging.error(f"Geocoding failed. Not enough data in Location file on lines {', '.join(map(str, failed))}")
 
         # write back updated dataframe to exposure object
         self.exposure_data.location.dataframe = location_df
-
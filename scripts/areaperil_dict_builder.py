@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Convert a model's keys_data/areaperil_dict.csv into the areaperil_dict.parquet
+GeoDataFrame read by the rtree peril lookup step.
+
+Grid models (PiWind and its variants) give the four corners of each area peril
+in lon1/lat1 .. lon4/lat4 columns; point models (UKWind, ParisWindstorm) give a
+single longitude/latitude. All geometries are built with one call to shapely's
+vectorised constructors, from coordinate arrays, rather than one shapely object
+per row.
+
+Each model's keys_data converter script calls convert() with its own settings.
+This script can also be run directly on a keys_data directory.
+
+Usage:
+    python areaperil_dict_builder.py PiWind/keys_data --polygon-point-order 1 2 4 3 --coverage-type 1
+    python areaperil_dict_builder.py UKWind/keys_data --geometry-column area_peril_geometry
+"""
+
+import argparse
+import os
+from typing import Optional, Sequence
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+
+def polygon_geometries(df: pd.DataFrame, point_order: Sequence[int]) -> np.ndarray:
+    """Polygons through the (lon<i>, lat<i>) corners of each row, taken in point_order."""
+    coords = np.stack([df[[f"lon{i}", f"lat{i}"]].to_numpy(dtype="float64") for i in point_order], axis=1)
+    return shapely.polygons(coords)
+
+
+def point_geometries(df: pd.DataFrame) -> np.ndarray:
+    """Points at the (longitude, latitude) of each row."""
+    return shapely.points(df["longitude"].to_numpy(dtype="float64"), df["latitude"].to_numpy(dtype="float64"))
+
+
+def convert(
+    keys_data_dir: str,
+    polygon_point_order: Optional[Sequence[int]] = None,
+    coverage_type: Optional[int] = None,
+    geometry_column: str = "geometry",
+    csv_name: str = "areaperil_dict.csv",
+    parquet_name: str = "areaperil_dict.parquet",
+) -> gpd.GeoDataFrame:
+    """
+    Write keys_data_dir/parquet_name from keys_data_dir/csv_name.
+
+    With polygon_point_order, each area peril is the polygon through its corners
+    in that order, and the corner columns are dropped; otherwise it is the point
+    at its longitude and latitude. With coverage_type, only the rows of that
+    coverage type are kept (the grid is the same for every coverage type) and
+    the coverage_type column is dropped.
+    """
+    df = pd.read_csv(os.path.join(keys_data_dir, csv_name))
+    df.rename(columns={column: column.lower() for column in df.columns}, inplace=True)
+
+    # remove duplicate for coverage
+    if coverage_type is not None:
+        df.drop(df[df["coverage_type"] != coverage_type].index, inplace=True)
+        df.drop(columns=["coverage_type"], inplace=True)
+
+    # create the GeoDataFrame and its geometry
+    if polygon_point_order:
+        df[geometry_column] = polygon_geometries(df, polygon_point_order)
+        # remove unused coordinate
+        df = df.drop(columns=[f"{axis}{i}" for i in polygon_point_order for axis in ("lon", "lat")])
+    else:
+        df[geometry_column] = point_geometries(df)
+    gdf_peril_area = gpd.GeoDataFrame(df, geometry=geometry_column)
+
+    # store to parquet format
+    gdf_peril_area.to_parquet(os.path.join(keys_data_dir, parquet_name))
+    return gdf_peril_area
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert areaperil_dict.csv to areaperil_dict.parquet.")
+    parser.add_argument("keys_data_dir", help="Model keys_data directory")
+    parser.add_argument("--polygon-point-order", type=int, nargs="+",
+                        help="Build polygons from the lon<i>/lat<i> columns in this order (default: points)")
+    parser.add_argument("--coverage-type", type=int, help="Only keep the area perils of this coverage type")
+    parser.add_argument("--geometry-column", default="geometry", help="Name of the geometry column (default: geometry)")
+    args = parser.parse_args()
+
+    gdf = convert(args.keys_data_dir, args.polygon_point_order, args.coverage_type, args.geometry_column)
+    print(f"  wrote {len(gdf)} area perils to {os.path.join(args.keys_data_dir, 'areaperil_dict.parquet')}")
+
+
+if __name__ == "__main__":
+    main()
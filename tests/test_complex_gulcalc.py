@@ -0,0 +1,277 @@
+"""
+Loss stream checks for the PiWindComplexModel gulcalc wrapper.
+
+The model runs in ``test_model_runs.py`` only ever read the uncompressed
+footprint, one process per event batch. These tests generate the Oasis files
+of ``PiWindComplexModel/tests/test_1`` once, then run
+``OasisLMF_ComplexModelExample_gulcalc`` directly against a zlib-compressed
+``footprint.bin.z`` (written with ``csvtobin footprint -z``) and with
+``--workers 2``, and check that every loss stream is byte-identical to the
+serial run on the uncompressed footprint. Batches started together on inputs
+with no shared model cache yet must give the same streams too.
+
+The complex_items.bin decoding is also checked directly, on small files
+written here.
+"""
+
+import json
+import os
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import msgpack
+import pytest
+
+REPO_ROOT = Path(__file__).parent.parent
+MODEL_DIR = REPO_ROOT / "PiWindComplexModel"
+TEST_DIR = MODEL_DIR / "tests" / "test_1"
+GULCALC = "OasisLMF_ComplexModelExample_gulcalc"
+BUILD_INTENSITY_TABLE = "OasisLMF_ComplexModelExample_build_intensity_table"
+
+# (event batch, number of batches) run for each variant: the first and last
+# batches, to keep the runs short while covering both ends of the event set
+EVENT_BATCHES = [(1, 10), (10, 10)]
+
+pytestmark = pytest.mark.skipif(
+    shutil.which(GULCALC) is None,
+    reason=f"{GULCALC} not installed (pip install -e PiWindComplexModel)",
+)
+
+
+def _run(cmd, cwd=None):
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if proc.returncode != 0:
+        pytest.fail(f"command failed: {' '.join(map(str, cmd))}\n--- output ---\n{proc.stdout}")
+    return proc.stdout
+
+
+# ---------------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------------
+
+
+@pytest.fixture(scope="module")
+def oasis_files(tmp_path_factory):
+    """
+    Oasis files of PiWindComplexModel/tests/test_1, with the analysis
+    settings and events.bin that a model run adds for the gulcalc.
+    """
+    files_dir = tmp_path_factory.mktemp("complex_model") / "input"
+    _run([
+        "oasislmf", "model", "generate-oasis-files",
+        "--config", str(TEST_DIR / "oasislmf.json"),
+        "--oasis-files-dir", str(files_dir),
+    ], cwd=TEST_DIR)
+    shutil.copy(TEST_DIR / "analysis_settings.json", files_dir)
+    # test_1 runs event_set 'p'
+    shutil.copy(MODEL_DIR / "model_data" / "events_p.bin", files_dir / "events.bin")
+    return files_dir
+
+
+def _gulcalc_dir(oasis_files, target, compressed):
+    """
+    A copy of the Oasis files as input/, next to a static/ holding only what
+    the gulcalc reads, with the footprint either as is or compressed.
+    """
+    shutil.copytree(oasis_files, target / "input")
+    static = target / "static"
+    static.mkdir()
+    model_data = MODEL_DIR / "model_data"
+    shutil.copy(model_data / "coverages.bin", static)
+    if compressed:
+        footprint_csv = target / "footprint.csv"
+        _run(["bintocsv", "footprint", "-i", model_data / "footprint.bin", "-x", model_data / "footprint.idx",
+              "-o", footprint_csv])
+        with open(model_data / "footprint.bin", "rb") as f:
+            num_intensity_bins = int.from_bytes(f.read(4), "little")
+        _run(["csvtobin", "footprint", "-z", "-m", str(num_intensity_bins), "-i", footprint_csv,
+              "-o", static / "footprint.bin.z", "-x", static / "footprint.idx.z"])
+    else:
+        shutil.copy(model_data / "footprint.bin", static)
+        shutil.copy(model_data / "footprint.idx", static)
+    return target
+
+
+@pytest.fixture(scope="module")
+def uncompressed_dir(oasis_files, tmp_path_factory):
+    return _gulcalc_dir(oasis_files, tmp_path_factory.mktemp("uncompressed"), compressed=False)
+
+
+@pytest.fixture(scope="module")
+def compressed_dir(oasis_files, tmp_path_factory):
+    return _gulcalc_dir(oasis_files, tmp_path_factory.mktemp("compressed"), compressed=True)
+
+
+def _gulcalc_cmd(run_dir, event_batch, output_path, *args):
+    return [
+        GULCALC,
+        "-e", *map(str, event_batch),
+        "-a", run_dir / "input" / "analysis_settings.json",
+        "-p", run_dir / "input",
+        "-i", output_path,
+        *args,
+    ]
+
+
+def _loss_stream(run_dir, event_batch, output_path, *args, log=None):
+    output = _run(_gulcalc_cmd(run_dir, event_batch, output_path, *args))
+    if log is not None:
+        log.append(output)
+    return output_path.read_bytes()
+
+
+def _without_caches(run_dir, target):
+    """A copy of a gulcalc run directory with none of the caches the gulcalc writes into input/."""
+    shutil.copytree(run_dir / "input", target / "input",
+                    ignore=shutil.ignore_patterns("complex_model_cache", ".complex_model_cache*", "*.npz"))
+    shutil.copytree(run_dir / "static", target / "static")
+    return target
+
+
+@pytest.fixture(scope="module")
+def serial_uncompressed_streams(uncompressed_dir):
+    """Loss stream of each event batch from the serial run on the uncompressed footprint."""
+    streams = {}
+    for event_batch in EVENT_BATCHES:
+        streams[event_batch] = _loss_stream(uncompressed_dir, event_batch, uncompressed_dir / f"gul_{event_batch[0]}.bin")
+        assert len(streams[event_batch]) > 8, f"no losses in batch {event_batch}"
+    return streams
+
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize("event_batch", EVENT_BATCHES, ids=lambda b: f"batch_{b[0]}_of_{b[1]}")
+@pytest.mark.parametrize("compressed,args", [
+    (True, []),
+    (False, ["--workers", "2"]),
+    (True, ["--workers", "2"]),
+], ids=["compressed", "workers_2", "compressed_workers_2"])
+def test_loss_stream_matches_serial_uncompressed(event_batch, compressed, args, serial_uncompressed_streams,
+                                                 uncompressed_dir, compressed_dir, tmp_path):
+    """The loss stream is the same bytes whichever footprint file and however many workers are used."""
+    actual = _loss_stream(compressed_dir if compressed else uncompressed_dir, event_batch,
+                          tmp_path / "gul.bin", *args)
+    assert actual == serial_uncompressed_streams[event_batch]
+
+
+def test_concurrent_batches_without_shared_cache(serial_uncompressed_streams, uncompressed_dir, tmp_path):
+    """Batches started together, all building the shared model cache, each get their full loss stream."""
+    run_dir = _without_caches(uncompressed_dir, tmp_path)
+    procs = [
+        subprocess.Popen(_gulcalc_cmd(run_dir, event_batch, tmp_path / f"gul_{event_batch[0]}.bin"),
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for event_batch in EVENT_BATCHES
+    ]
+    outputs = [proc.communicate()[0] for proc in procs]
+    for event_batch, proc, output in zip(EVENT_BATCHES, procs, outputs):
+        assert proc.returncode == 0, f"batch {event_batch} failed:\n{output}"
+        assert (tmp_path / f"gul_{event_batch[0]}.bin").read_bytes() == serial_uncompressed_streams[event_batch]
+
+
+def test_shared_cache_built_meanwhile_is_kept(uncompressed_dir, tmp_path, monkeypatch):
+    """
+    A batch that finds an up to date shared cache in place once it has built
+    its own keeps the existing one, which other batches may be loading.
+    """
+    gulcalc = pytest.importorskip("complex_model_wrapper.OasisLMF_ComplexModelExample_gulcalc")
+    run_dir = _without_caches(uncompressed_dir, tmp_path)
+    inputs_dir, static_dir = str(run_dir / "input"), str(run_dir / "static")
+    cache_dir = os.path.join(inputs_dir, gulcalc.SHARED_CACHE_DIRNAME)
+
+    # batch B starts with no cache, and batch A attaches its own while B reads the inputs
+    batch_a = {}
+    read_model_inputs = gulcalc.read_model_inputs
+
+    def read_model_inputs_while_batch_a_attaches(*args, **kwargs):
+        monkeypatch.setattr(gulcalc, "read_model_inputs", read_model_inputs)
+        batch_a["arrays"] = gulcalc.attach_shared_cache(inputs_dir, static_dir, "complex_items.bin")
+        batch_a["inode"] = os.stat(cache_dir).st_ino
+        return read_model_inputs(*args, **kwargs)
+
+    monkeypatch.setattr(gulcalc, "read_model_inputs", read_model_inputs_while_batch_a_attaches)
+    assert gulcalc.prepare_shared_cache(inputs_dir, static_dir) == cache_dir
+
+    assert os.stat(cache_dir).st_ino == batch_a["inode"]
+    assert sorted(n for n in os.listdir(inputs_dir) if gulcalc.SHARED_CACHE_DIRNAME in n) == [
+        f".{gulcalc.SHARED_CACHE_DIRNAME}.lock", gulcalc.SHARED_CACHE_DIRNAME]
+    batch_b = gulcalc.attach_shared_cache(inputs_dir, static_dir, "complex_items.bin")
+    for name, values in batch_a["arrays"].items():
+        assert (batch_b[name] == values).all()
+
+
+def test_intensity_table(serial_uncompressed_streams, uncompressed_dir, tmp_path):
+    """
+    The precomputed intensity table gives the same loss stream, and is
+    ignored with a warning once the footprint's modification time changes.
+    """
+    run_dir = _without_caches(uncompressed_dir, tmp_path)
+    _run([BUILD_INTENSITY_TABLE, run_dir / "static"])
+    assert (run_dir / "static" / "footprint_intensity.bin").is_file()
+
+    for event_batch in EVENT_BATCHES:
+        log = []
+        actual = _loss_stream(run_dir, event_batch, tmp_path / "gul.bin", log=log)
+        assert actual == serial_uncompressed_streams[event_batch]
+        assert "precomputed footprint intensity table" in log[0]
+
+    footprint = run_dir / "static" / "footprint.bin"
+    st = footprint.stat()
+    os.utime(footprint, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    log = []
+    actual = _loss_stream(run_dir, EVENT_BATCHES[0], tmp_path / "gul.bin", log=log)
+    assert actual == serial_uncompressed_streams[EVENT_BATCHES[0]]
+    assert "Ignoring" in log[0] and "rebuild it" in log[0]
+    assert "precomputed footprint intensity table" not in log[0]
+
+
+def _write_complex_items(path, model_data):
+    """complex_items.bin of one item per model_data bytes, with item_id i, coverage_id i and group_id i."""
+    with open(path, "wb") as f:
+        for i, md in enumerate(model_data, start=1):
+            f.write(struct.pack("<iIII", i, i, i, len(md)))
+            f.write(md)
+
+
+def _json_model_data(area_peril_id, **extra):
+    return msgpack.packb(json.dumps({"area_peril_id": area_peril_id, "vulnerability_id": 1, **extra}))
+
+
+@pytest.mark.parametrize("model_data", [
+    # the keys lookup's schema, parsed from the raw bytes
+    [_json_model_data(apid) for apid in (5, 123456, 7, 2147483647)],
+    # the generic decoder: msgpack maps, JSON with other keys first, a missing area_peril_id
+    [msgpack.packb({"area_peril_id": 5}), msgpack.packb(json.dumps({"vulnerability_id": 1, "area_peril_id": 6})),
+     msgpack.packb(json.dumps({"vulnerability_id": 1}))],
+], ids=["fast_path", "generic"])
+def test_read_complex_items(model_data, tmp_path):
+    gulcalc = pytest.importorskip("complex_model_wrapper.OasisLMF_ComplexModelExample_gulcalc")
+    _write_complex_items(tmp_path / "complex_items.bin", model_data)
+
+    item_ids, coverage_ids, group_ids, area_peril_ids = gulcalc.read_complex_items(
+        str(tmp_path), "complex_items.bin", use_cache=False)
+
+    expected = []
+    for md in model_data:
+        md = msgpack.unpackb(md, raw=False)
+        expected.append((json.loads(md) if isinstance(md, str) else md).get("area_peril_id", 0))
+    n = len(model_data)
+    assert item_ids.tolist() == coverage_ids.tolist() == group_ids.tolist() == list(range(1, n + 1))
+    assert area_peril_ids.tolist() == expected
+
+
+@pytest.mark.parametrize("model_data", [
+    [_json_model_data(5), b"", _json_model_data(7)],
+    # as many objects as records, but not one per record
+    [_json_model_data(5), b"", _json_model_data(7) + _json_model_data(8)],
+], ids=["empty", "misaligned"])
+def test_read_complex_items_rejects_bad_model_data(model_data, tmp_path):
+    gulcalc = pytest.importorskip("complex_model_wrapper.OasisLMF_ComplexModelExample_gulcalc")
+    _write_complex_items(tmp_path / "complex_items.bin", model_data)
+
+    with pytest.raises(ValueError, match="record 1"):
+        gulcalc.read_complex_items(str(tmp_path), "complex_items.bin", use_cache=False)
@@ -0,0 +1,184 @@
+"""
+Checks of the ComplexModelAPI loss API client against its local mock server.
+
+The ComplexModelAPI model runs are skipped in ``test_model_runs.py``, so these
+tests start ``mock_api_server.create_app()`` in-process and check that
+``api_hook.iter_api(api_url=...)`` gives the same losses as the static dummy
+hook, with at most ``max_in_flight`` loss requests outstanding. They also
+check that the items are uploaded again when the API loses them, between or
+during runs, and that batches starting together upload them only once.
+
+ComplexModelAPI and PiWindComplexModel both name their package
+``complex_model_wrapper``, so the ComplexModelAPI one is loaded from its
+directory under another name.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import sys
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+REPO_ROOT = Path(__file__).parent.parent
+PACKAGE_DIR = REPO_ROOT / "ComplexModelAPI" / "complex_model_wrapper"
+PACKAGE_NAME = "complex_model_api_wrapper"
+
+EVENT_IDS = np.arange(1, 41)
+NUMBER_OF_SAMPLES = 3
+MAX_IN_FLIGHT = 4
+
+
+def _load_package():
+    if PACKAGE_NAME not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            PACKAGE_NAME, PACKAGE_DIR / "__init__.py", submodule_search_locations=[str(PACKAGE_DIR)])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[PACKAGE_NAME] = package
+        spec.loader.exec_module(package)
+    return (importlib.import_module(f"{PACKAGE_NAME}.api_hook"),
+            importlib.import_module(f"{PACKAGE_NAME}.mock_api_server"))
+
+
+api_hook, mock_api_server = _load_package()
+
+
+class MockServer:
+    """The mock API on a free local port, served from an event loop in a background thread."""
+
+    def __init__(self, latency=0.01):
+        self.app = mock_api_server.create_app(latency)
+        self.in_flight = self.max_in_flight = 0
+
+        @web.middleware
+        async def count_loss_requests(request, handler):
+            if request.path != "/losses":
+                return await handler(request)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                return await handler(request)
+            finally:
+                self.in_flight -= 1
+
+        self.app.middlewares.append(count_loss_requests)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.runner = web.AppRunner(self.app)
+        self._call(self.runner.setup())
+        self._call(web.TCPSite(self.runner, "127.0.0.1", 0).start())
+        self.url = "http://127.0.0.1:%d" % self.runner.addresses[0][1]
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def request(self, method, path):
+        """HTTP status of a request to the server."""
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, method=method)) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def close(self):
+        self._call(self.runner.cleanup())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+@pytest.fixture
+def server():
+    server = MockServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def df_items():
+    item_ids = np.arange(1, 21)
+    return pd.DataFrame({"item_id": item_ids, "coverage_id": (item_ids + 1) // 2, "group_id": item_ids})
+
+
+def _static_losses(df_items):
+    return pd.concat(api_hook.iter_api(1, EVENT_IDS, NUMBER_OF_SAMPLES, df_items), ignore_index=True)
+
+
+def _items_path(client_log):
+    """The /items/<digest> path the client uploaded to, from its log."""
+    uploads = [r.getMessage() for r in client_log.records if r.getMessage().startswith("Uploading")]
+    return "/items/" + uploads[0].rsplit("/", 1)[1]
+
+
+def _api_losses(events):
+    return pd.concat(events, ignore_index=True)
+
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+
+def test_losses_match_static_hook(server, df_items, tmp_path):
+    losses = _api_losses(api_hook.iter_api(1, EVENT_IDS, NUMBER_OF_SAMPLES, df_items, api_url=server.url,
+                                           max_in_flight=MAX_IN_FLIGHT, cache_dir=str(tmp_path)))
+
+    pd.testing.assert_frame_equal(losses, _static_losses(df_items), check_dtype=False)
+    assert 1 < server.max_in_flight <= MAX_IN_FLIGHT
+
+
+def test_items_lost_between_runs_are_uploaded_again(server, df_items, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    _api_losses(api_hook.iter_api(1, EVENT_IDS, NUMBER_OF_SAMPLES, df_items, api_url=server.url,
+                                  cache_dir=str(tmp_path)))
+    items_path = _items_path(caplog)
+
+    # the handle file still records the upload, but the API has lost the items
+    assert server.request("DELETE", items_path) == 200
+    caplog.clear()
+    losses = _api_losses(api_hook.iter_api(2, EVENT_IDS, NUMBER_OF_SAMPLES, df_items, api_url=server.url,
+                                           cache_dir=str(tmp_path)))
+
+    pd.testing.assert_frame_equal(losses, _static_losses(df_items), check_dtype=False)
+    assert _items_path(caplog) == items_path
+    assert not any("no longer holds" in r.getMessage() for r in caplog.records)
+
+
+def test_items_lost_during_run_are_uploaded_again(server, df_items, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    events = api_hook.iter_api(1, EVENT_IDS, NUMBER_OF_SAMPLES, df_items, api_url=server.url,
+                               max_in_flight=MAX_IN_FLIGHT, cache_dir=str(tmp_path))
+    first = [next(events) for _ in range(10)]
+    items_path = _items_path(caplog)
+
+    assert server.request("DELETE", items_path) == 200
+    losses = _api_losses(first + list(events))
+
+    pd.testing.assert_frame_equal(losses, _static_losses(df_items), check_dtype=False)
+    assert sum("no longer holds" in r.getMessage() for r in caplog.records) == 1
+    assert server.request("HEAD", items_path) == 200
+
+
+def test_concurrent_batches_upload_items_once(server, df_items, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    api_client = importlib.import_module(f"{PACKAGE_NAME}.api_client")
+
+    def send_items(_):
+        return api_client.LossApiClient(server.url).send_items(df_items, str(tmp_path))
+
+    with ThreadPoolExecutor(4) as pool:
+        handles = set(pool.map(send_items, range(4)))
+
+    assert len(handles) == 1
+    assert sum(r.getMessage().startswith("Uploading") for r in caplog.records) == 1
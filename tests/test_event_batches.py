@@ -0,0 +1,43 @@
+"""
+Checks of the event batching shared by the complex model wrappers.
+
+PiWindComplexModel and ComplexModelAPI each ship a copy of
+``complex_model_wrapper/event_batches.py``, and their batches only agree on
+which events they own while the copies are the same.
+"""
+
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+REPO_ROOT = Path(__file__).parent.parent
+EVENT_BATCHES_COPIES = [
+    REPO_ROOT / model / "complex_model_wrapper" / "event_batches.py"
+    for model in ("PiWindComplexModel", "ComplexModelAPI")
+]
+
+
+@pytest.fixture(scope="module")
+def event_batches():
+    spec = importlib.util.spec_from_file_location("event_batches", EVENT_BATCHES_COPIES[0])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_copies_are_identical():
+    first, *others = [path.read_bytes() for path in EVENT_BATCHES_COPIES]
+    for path, other in zip(EVENT_BATCHES_COPIES[1:], others):
+        assert other == first, f"{path} differs from {EVENT_BATCHES_COPIES[0]}, keep the copies identical"
+
+
+@pytest.mark.parametrize("n_events,max_event_batch", [(1, 1), (10, 3), (100, 10), (7, 10), (1000, 40)])
+def test_batches_partition_the_events(event_batches, n_events, max_event_batch):
+    event_ids = np.arange(1, n_events + 1, dtype=np.int32) * 3
+    batches = [event_batches.batch_event_ids(event_ids, n, max_event_batch) for n in range(1, max_event_batch + 1)]
+
+    all_batches = np.concatenate(batches)
+    assert np.array_equal(all_batches, event_batches.shuffle_events(event_ids))
+    assert np.array_equal(np.sort(all_batches), event_ids)
@@ -0,0 +1,79 @@
+"""
+Checks of the PiWindPostcode exposure pre-analysis disaggregation.
+
+The model runs in ``test_model_runs.py`` compare losses, so they would not
+notice locations whose NumberOfBuildings no longer add up after being split
+across OccupancyCodes. These tests load the hook from its file, as oasislmf
+does, and check that the buildings of every source location are kept exactly,
+both in ``allocate_buildings()`` and in a run of the hook on the locations of
+``PiWindPostcode/tests/test_6``, which include shares that rounding would
+not add up.
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_ROOT = Path(__file__).parent.parent
+HOOK_PATH = REPO_ROOT / "PiWindPostcode" / "src" / "exposure_modification" / "exposure_pre_analysis_disagg.py"
+TEST_DIR = REPO_ROOT / "PiWindPostcode" / "tests" / "test_6"
+
+
+@pytest.fixture(scope="module")
+def hook():
+    spec = importlib.util.spec_from_file_location("exposure_pre_analysis_disagg", HOOK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("number_of_buildings,weights,expected", [
+    # rounding gives 1 + 1 + 1 = 3
+    (2, [1 / 3, 1 / 3, 1 / 3], [1, 1, 0]),
+    # rounding half to even gives 2 + 2 = 4
+    (3, [0.5, 0.5], [2, 1]),
+    # rounding gives 0 + 0 + 3 = 3
+    (4, [0.121, 0.034, 0.845], [1, 0, 3]),
+    # rounding gives 1 + 19 + 1 = 21
+    (20, [0.0265, 0.947, 0.0265], [1, 19, 0]),
+])
+def test_allocate_buildings_keeps_the_total(hook, number_of_buildings, weights, expected):
+    weights = np.array(weights)
+    assert (number_of_buildings * weights).round().sum() != number_of_buildings
+
+    allocated = hook.allocate_buildings(np.full(len(weights), number_of_buildings), weights, np.zeros(len(weights)))
+    assert allocated.tolist() == expected
+
+
+def test_allocate_buildings_keeps_every_location_total(hook):
+    rng = np.random.default_rng(0)
+    source_rows = np.repeat(np.arange(1000), rng.integers(1, 6, 1000))
+    weights = rng.random(len(source_rows))
+    weights /= np.bincount(source_rows, weights=weights)[source_rows]
+    buildings = rng.integers(2, 50, 1000)
+
+    allocated = hook.allocate_buildings(buildings[source_rows], weights, source_rows)
+    assert np.array_equal(np.bincount(source_rows, weights=allocated), buildings)
+    assert np.all(allocated >= 0) and np.array_equal(allocated, np.round(allocated))
+
+
+def test_hook_keeps_every_location_total(hook):
+    source = pd.read_csv(TEST_DIR / json.loads((TEST_DIR / "oasislmf.json").read_text())["oed_location_csv"])
+    settings = json.loads((TEST_DIR / "exposure_pre_analysis.json").read_text())
+    settings["Built_environment"] = str((HOOK_PATH.parent / settings["Built_environment"]).resolve())
+    exposure_data = SimpleNamespace(location=SimpleNamespace(dataframe=source.copy()))
+
+    hook.ExposurePreAnalysis(exposure_data, settings).run()
+    output = exposure_data.location.dataframe
+
+    # disaggregated LocNumbers are 'LocNumber_counter'
+    output_loc_number = output["LocNumber"].astype(str).str.split("_").str[0].astype(source["LocNumber"].dtype)
+    totals = output.groupby([output["AccNumber"], output_loc_number])["NumberOfBuildings"].sum()
+    expected = source.set_index(["AccNumber", "LocNumber"])["NumberOfBuildings"]
+    assert len(output) > len(source)
+    assert totals.sort_index().tolist() == expected.sort_index().tolist()